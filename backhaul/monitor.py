@@ -11,7 +11,9 @@ import threading
 
 from django.conf import settings
 
+from frontend import archives, cache
 from frontend.models import Day, Sweep
+from radarhub.dbrouter import use_primary
 from common import colorize, colored_variables
 
 logger = logging.getLogger("backhaul")
@@ -32,6 +34,18 @@ def relay_event(data):
     relay.publish("sse-relay", json_data)
 
 
+def publish_catchup(pathway):
+    # There is no Relay in this process, so drop the month summaries that may have changed
+    archives.month_cache.clear()
+    tic = time.time()
+    payload = archives.catchup_snapshot(pathway)
+    cache.publish_catchup(pathway, payload)
+    if settings.VERBOSE > 1:
+        myname = colorize("publish_catchup()", "green")
+        elapsed = time.time() - tic
+        logger.debug(f"{myname}   {colored_variables(pathway)}   {elapsed:.3f} s")
+
+
 def monitor(delay=1.0):
     myname = colorize("monitor()", "green")
     Sweep.setLogger(logger)
@@ -52,7 +66,7 @@ def monitor(delay=1.0):
             hourly_count = day.hourly_count
             sweeps = Sweep.objects.filter(time__range=day.latest_datetime_range, name=name)
         else:
-            hourly_count = ",".join("0" * 24)
+            hourly_count = (0,) * 24
             logger.info(f"{myname} No Day objects yet for {pathway} / {name}")
         count = len(sweeps)
         logger.info(f"{myname} Building cache for {colored_variables(pathway)} ...")
@@ -73,6 +87,7 @@ def monitor(delay=1.0):
         for t in threads:
             t.join()
         collection[pathway] = (sweeps, hourly_count)
+        publish_catchup(pathway)
 
     logger.info(f"{myname} Started")
 
@@ -103,16 +118,20 @@ def monitor(delay=1.0):
             # Do a read to cache the latest data
             for sweep in delta:
                 logger.info(f"{myname} Added new: {name}-{sweep.locator} ...")
+                # A re-ingested sweep gets a new entry, drop the payloads rendered from the previous one
+                cache.invalidate(f"{name}-{sweep.locator}-")
                 # sweep.load()
             data = {
                 "pathway": pathway,
                 "items": [sweep.locator for sweep in delta],
-                "hoursActive": [int(c) for c in hourly_count.split(",")],
+                "hoursActive": list(hourly_count),
                 "time": datetime.datetime.now(datetime.UTC).isoformat(),
             }
             busy_count += 1
             relay_event(data)
             collection[pathway] = (latest_sweeps, hourly_count)
+            # Every daphne process serves /data/catchup from this snapshot
+            publish_catchup(pathway)
         if busy_count == 0:
             if settings.VERBOSE > 1 and settings.DEBUG:
                 logger.debug(f"{myname} Sleeping ...")
@@ -183,6 +202,8 @@ def signalHandler(signum, frame):
 
 
 def launch():
+    # The catchup snapshots are taken right after new sweeps, which the replica may not have yet
+    use_primary()
     if settings.SIMULATE:
         thread = threading.Thread(target=simulate)
     else:
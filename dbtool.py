@@ -28,9 +28,14 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "radarhub.settings")
 django.setup()
 
 from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Count
+from django.db.models.functions import ExtractHour
 from common import colorize, truncate_array, colored_variables
 from common import log_format, log_indent
+from frontend import cache
 from frontend.models import Sweep, Day, Visitor
+from radarhub.dbrouter import use_primary
 from setproctitle import setproctitle
 
 __prog__ = os.path.splitext(os.path.basename(sys.argv[0]))[0]
@@ -418,6 +423,9 @@ def xz_folder(folder, **kwargs):
                         x.path = path
                         x.symbols = symbols
                         x.tarinfo = tarinfo
+                        # Gate counts of the previous archive, tallied again by Day.summarize() when needed
+                        for k in Sweep.tally_fields:
+                            setattr(x, k, None)
                         updates.append(x)
                     else:
                         mode = "I"
@@ -431,8 +439,13 @@ def xz_folder(folder, **kwargs):
                 Sweep.objects.bulk_create(creates)
             if len(updates):
                 Sweep.objects.bulk_update(
-                    updates, ["time", "name", "kind", "scan", "path", "symbols", "tarinfo"], batch_size=1000
+                    updates,
+                    ["time", "name", "kind", "scan", "path", "symbols", "tarinfo"] + Sweep.tally_fields,
+                    batch_size=1000,
                 )
+                # Payloads rendered from the previous entries are no longer valid
+                for x in updates:
+                    cache.invalidate(f"{name}-{x.locator}-")
             t = tm.time() - t
             a = len(keys) / t
             logger.info(
@@ -472,37 +485,32 @@ def build_day(source, bgor=False, verbose=0):
         logger.error(f"Error. build_day() needs an exact date.")
         return None
 
-    date_range = params["date_range"]
-    if date_range:
-        sweeps = Sweep.objects.filter(time__range=date_range, name=name)
-        if sweeps.count() == 0:
-            logger.error(f"Error. No Sweep entries for {date_range} / {name}")
-            return None
+    tic = tm.time()
 
+    # All 24 hourly counts in one GROUP BY query
     day_string = date.strftime(r"%Y-%m-%d")
-
-    tic = tm.time()
+    date_range = [f"{day_string} 00:00:00Z", f"{day_string} 23:59:59.9Z"]
+    sweeps = Sweep.objects.filter(time__range=date_range, name=name)
+    rows = sweeps.annotate(hour=ExtractHour("time")).values("hour").annotate(count=Count("id")).order_by()
+    counts = [0] * 24
+    for row in rows:
+        counts[row["hour"]] = row["count"]
+    total = sum(counts)
+    if total == 0:
+        logger.error(f"Error. No Sweep entries for {date_range} / {name}")
+        return None
 
     mode = "N"
-    day = Day.objects.filter(date=date, name=name)
+    day = Day.objects.filter(date=date, name=name).first()
     if day:
         mode = "U"
-        day = day.first()
     else:
         day = Day(date=date, name=name)
 
-    total = 0
-    counts = [0] * 24
-    for k in range(24):
-        date_range = [f"{day_string} {k:02d}:00:00Z", f"{day_string} {k:02d}:59:59.9Z"]
-        matches = Sweep.objects.filter(time__range=date_range, name=name)
-        counts[k] = matches.count()
-        total += counts[k]
-
     if total > 0:
         day.count = total
         day.duration = day.count * 20
-        day.hourly_count = ",".join([str(c) for c in counts])
+        day.hourly_count = counts
         day.save()
     elif mode == "U" and total == 0:
         mode = "D"
@@ -517,6 +525,9 @@ def build_day(source, bgor=False, verbose=0):
     else:
         logger.debug(f"{mode} {day}")
 
+    if mode != "I":
+        cache.invalidate_month(name, date)
+
     tic = tm.time() - tic
 
     logger.debug(f"Elapsed time: {tic:.2f}s")
@@ -609,6 +620,7 @@ def check_source(source, progress=True, remove=False):
                 if day:
                     day = day.first()
                     day.delete()
+                    cache.invalidate_month(name, day.date)
             else:
                 build_day(source, bgor=True)
 
@@ -723,6 +735,280 @@ def show_sweep_summary(source, markdown=False):
         logger.info(f"No entry found for {source}")
 
 
+def _column_type(connection, table, column):
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+            [table, column],
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def repack_days(batch=1000):
+    """
+    Repacks the Day.hourly_count still in the legacy comma-separated form into the packed form
+
+    Rows migrated from the CharField are cast to bytes as-is, e.g., b"0,0,...,3", which
+    HourlyCountField reads fine but slower. This rewrites them as 24 uint32, so run this
+    after migrate
+    """
+    myname = colorize("repack_days()", "green")
+    table = Day._meta.db_table
+    connection = connections[router.db_for_write(Day)]
+    kind = _column_type(connection, table, "hourly_count")
+    if kind not in (None, "bytea"):
+        logger.error(f"{myname} {table}.hourly_count is {kind}, run migrate first")
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT id, hourly_count FROM {table}")
+        rows = cursor.fetchall()
+    legacy = [k for k, v in rows if isinstance(v, str) or b"\x00" not in bytes(v)]
+    total = len(rows)
+    count = len(legacy)
+    logger.info(f"{myname}   {colored_variables(total, count)}")
+    for k in tqdm.tqdm(range(0, count, batch), desc=f"{log_indent}Repacking ...") if count else []:
+        days = list(Day.objects.filter(id__in=legacy[k : k + batch]))
+        Day.objects.bulk_update(days, ["hourly_count"])
+    return count
+
+
+def _tarinfo_stats(connection, sample=1000):
+    """
+    Returns the size of Sweep.tarinfo, the size of the table, and the time to decode the
+    Sweep.tarinfo of the latest `sample` rows (us / row)
+    """
+    table = Sweep._meta.db_table
+    field = Sweep._meta.get_field("tarinfo")
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT coalesce(sum(length(tarinfo)), 0) FROM {table}")
+        size = cursor.fetchone()[0]
+        total = None
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+            total = cursor.fetchone()[0]
+        cursor.execute(f"SELECT tarinfo FROM {table} ORDER BY id DESC LIMIT %s", [sample])
+        rows = [bytes(x) if isinstance(x, memoryview) else x for x, in cursor.fetchall()]
+    tic = tm.perf_counter()
+    for row in rows:
+        field.to_python(row)
+    decode = (tm.perf_counter() - tic) / max(len(rows), 1) * 1.0e6
+    return size, total, decode
+
+
+def repack_sweeps(batch=1000):
+    """
+    Repacks the Sweep.tarinfo still in the legacy JSON form into the packed form of TarinfoField
+
+    On PostgreSQL, the jsonb column is first cast to bytea (UTF-8 text of the JSON), which makes
+    the migration from the JSONField a no-op, so run this before migrate. Reports the column size,
+    the table size and the decode time, before and after
+    """
+    myname = colorize("repack_sweeps()", "green")
+    table = Sweep._meta.db_table
+    version = bytes([Sweep._meta.get_field("tarinfo").version])
+    connection = connections[router.db_for_write(Sweep)]
+    with connection.cursor() as cursor:
+        if _column_type(connection, table, "tarinfo") == "jsonb":
+            logger.info(f"{myname} Casting {table}.tarinfo from jsonb to bytea ...")
+            cursor.execute(
+                f"ALTER TABLE {table} ALTER COLUMN tarinfo TYPE bytea USING convert_to(tarinfo::text, 'UTF8')"
+            )
+        cursor.execute(f"SELECT id FROM {table} WHERE substr(tarinfo, 1, 1) <> %s", [version])
+        legacy = [x for x, in cursor.fetchall()]
+    before = _tarinfo_stats(connection)
+    count = len(legacy)
+    logger.info(f"{myname}   {colored_variables(count)}")
+    for k in tqdm.tqdm(range(0, count, batch), desc=f"{log_indent}Repacking ...") if count else []:
+        sweeps = list(Sweep.objects.filter(id__in=legacy[k : k + batch]).only("id", "name", "time", "scan", "tarinfo"))
+        Sweep.objects.bulk_update(sweeps, ["tarinfo"])
+    if connection.vendor == "postgresql":
+        # Reclaim the space of the rewritten rows so that the table size is comparable
+        with connection.cursor() as cursor:
+            cursor.execute(f"VACUUM FULL {table}")
+    after = _tarinfo_stats(connection)
+    message = "| Sweep.tarinfo | Column (B) | Table (B) | Decode (us / row) |\n|---|---|---|---|\n"
+    for label, (size, total, decode) in [("Before", before), ("After", after)]:
+        total = f"{total:,d}" if total else "-"
+        message += f"| {label} | {size:,d} | {total} | {decode:.2f} |\n"
+    print(message)
+    return count
+
+
+def _month_start(date, months=0):
+    k = date.year * 12 + date.month - 1 + months
+    return datetime.datetime(k // 12, k % 12 + 1, 1, tzinfo=tzinfo)
+
+
+def _sweep_partitions(cursor):
+    table = Sweep._meta.db_table
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", [table])
+    row = cursor.fetchone()
+    if row is None or row[0] != "p":
+        return None
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s",
+        [table],
+    )
+    return sorted(x[0] for x in cursor.fetchall())
+
+
+def _create_sweep_partition(cursor, start):
+    """
+    Creates the monthly partition of Sweep that begins at `start`, rows of the month that
+    went into the default partition in the meantime are moved into it
+    """
+    table = Sweep._meta.db_table
+    end = _month_start(start, 1)
+    partition = f"{table}_y{start.year}m{start.month:02d}"
+    bounds = f"FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    cursor.execute(f"SELECT count(*) FROM {table}_default WHERE time >= %s AND time < %s", [start, end])
+    stray = cursor.fetchone()[0]
+    if stray == 0:
+        cursor.execute(f"CREATE TABLE {partition} PARTITION OF {table} FOR VALUES {bounds}")
+    else:
+        # A partition cannot be added while the default partition holds rows of its range
+        cursor.execute(f"CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        cursor.execute(
+            f"INSERT INTO {partition} SELECT * FROM {table}_default WHERE time >= %s AND time < %s", [start, end]
+        )
+        cursor.execute(f"DELETE FROM {table}_default WHERE time >= %s AND time < %s", [start, end])
+        cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {partition} FOR VALUES {bounds}")
+    logger.info(f"Created {partition}   {colored_variables(stray)}")
+    return partition
+
+
+def partition_sweeps(ahead=3):
+    """
+    Partitions the Sweep table by month of `time` on PostgreSQL
+
+    - ahead - number of future months to create partitions for
+
+    The first run converts the table in place, which copies every row, so run it during a quiet
+    period. Subsequent runs only add the partitions of the upcoming months, e.g., from a monthly
+    cron job. Rows beyond the last partition land in a default partition and are moved into their
+    own partition when it is created. The primary key becomes (id, time) since every unique
+    constraint of a partitioned table must include the partition key
+    """
+    myname = colorize("partition_sweeps()", "green")
+    db = router.db_for_write(Sweep)
+    connection = connections[db]
+    if connection.vendor != "postgresql":
+        logger.error(f"{myname} Partitioning needs PostgreSQL, {db} is {connection.vendor}")
+        return None
+    table = Sweep._meta.db_table
+    now = datetime.datetime.now(tzinfo)
+    with transaction.atomic(using=db), connection.cursor() as cursor:
+        partitions = _sweep_partitions(cursor)
+        if partitions is None:
+            cursor.execute(f"SELECT count(*), min(time), max(time) FROM {table}")
+            count, first, last = cursor.fetchone()
+            logger.info(f"{myname} Converting {table}   {colored_variables(count, first, last)}")
+            heap = f"{table}_heap"
+            cursor.execute(f"ALTER TABLE {table} RENAME TO {heap}")
+            cursor.execute(
+                f"CREATE TABLE {table} (LIKE {heap} INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING CONSTRAINTS) "
+                "PARTITION BY RANGE (time)"
+            )
+            cursor.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id, time)")
+            # A serial id (before Django 4.1) keeps its sequence, which must outlive the old table
+            cursor.execute(
+                "SELECT attidentity FROM pg_attribute WHERE attrelid = %s::regclass AND attname = 'id'", [heap]
+            )
+            if cursor.fetchone()[0] == "":
+                cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [heap])
+                cursor.execute(f"ALTER SEQUENCE {cursor.fetchone()[0]} OWNED BY {table}.id")
+            cursor.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+            start = _month_start(first or now)
+            partitions = []
+            while start <= _month_start(last or now):
+                partitions.append(_create_sweep_partition(cursor, start))
+                start = _month_start(start, 1)
+            tic = tm.time()
+            cursor.execute(f"INSERT INTO {table} SELECT * FROM {heap}")
+            cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), coalesce(max(id), 1)) FROM {table}")
+            cursor.execute(f"DROP TABLE {heap}")
+            logger.info(f"{myname} Copied {count:,d} rows in {tm.time() - tic:.1f} s")
+            # Indexes created on the parent cascade to every partition, present and future
+            with connection.schema_editor(atomic=False) as editor:
+                for index in Sweep._meta.indexes:
+                    editor.add_index(Sweep, index)
+        for k in range(ahead + 1):
+            start = _month_start(now, k)
+            if f"{table}_y{start.year}m{start.month:02d}" not in partitions:
+                partitions.append(_create_sweep_partition(cursor, start))
+    count = len(partitions)
+    logger.info(f"{myname} {table} has {count} partitions")
+    return partitions
+
+
+def explain_queries(source=[], markdown=False):
+    """
+    Runs EXPLAIN on the hot queries of each radar and flags the sequential scans
+
+    - source - list of prefixes, e.g., ["PX", "RAXPOL"], default = all radars
+    """
+    myname = colorize("explain_queries()", "green")
+    names = source or [item["prefix"] for item in settings.RADARS.values()]
+    logger.info(f"{myname}   {colored_variables(names)}")
+    message = "| Query | Plan |\n|---|---|\n"
+    flagged = 0
+    connection = connections[router.db_for_read(Sweep)]
+    partitioned = False
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            partitioned = _sweep_partitions(cursor) is not None
+    for name in names:
+        day = Day.objects.filter(name=name).order_by("date").last()
+        if day is None:
+            logger.info(f"{myname} No Day entry for {name}")
+            continue
+        date = day.date
+        hour = day.latest_datetime_range
+        scan = next((x["summary"] for x in settings.RADARS.values() if x["prefix"] == name), "E4.0")
+        time = datetime.datetime.strptime(hour[0], r"%Y-%m-%d %H:%M:%SZ").replace(tzinfo=tzinfo)
+        queries = {
+            "_table": Sweep.objects.filter(time__range=hour, name=name),
+            "Sweep.read": Sweep.objects.filter(time=time, name=name),
+            "_latest_scan": Sweep.objects.filter(time__range=hour, name=name, scan=scan).order_by("-time")[:1],
+            "build_day": Sweep.objects.filter(time__range=day.day_range, name=name),
+            "load_many": Sweep.objects.filter(time__range=hour, name=name, scan=scan).order_by("time"),
+            "_month": Day.objects.filter(date__year=date.year, date__month=date.month, name=name),
+            "_count": Day.objects.filter(date=date, name=name),
+            "latest": Day.objects.filter(name=name).order_by("-date")[:1],
+        }
+        for label, query in queries.items():
+            plan = query.explain()
+            # PostgreSQL: "Seq Scan on frontend_sweep", SQLite: "SCAN frontend_sweep" (without USING INDEX)
+            sequential = [
+                x.strip()
+                for x in plan.splitlines()
+                if "Seq Scan" in x or (re.search(r"\bSCAN\b", x) and "INDEX" not in x)
+            ]
+            # Queries within an hour should prune to the partition of their month
+            pattern = rf"\b{Sweep._meta.db_table}_(?:y\d{{4}}m\d{{2}}|default)\b"
+            scanned = set(re.findall(pattern, plan)) if partitioned else set()
+            if sequential:
+                flagged += 1
+                logger.warning(f"{myname} {colorize(f'{name} {label}', 'orange')}   {sequential[0]}")
+            elif label in ["_table", "Sweep.read"] and len(scanned) > 1:
+                flagged += 1
+                logger.warning(f"{myname} {colorize(f'{name} {label}', 'orange')}   {len(scanned)} partitions")
+            else:
+                logger.info(f"{myname} {name} {label}   {colorize('okay', 'green')}")
+            logger.debug(f"{label}:\n{plan}")
+            summary = "<br>".join(plan.splitlines())
+            message += f"| {name} {label} | {summary} |\n"
+    if markdown:
+        print(message)
+    if flagged:
+        logger.warning(f"{myname} {flagged} quer{'ies' if flagged > 1 else 'y'} with sequential scans")
+    return flagged
+
+
 def show_visitor_log(markdown=False, show_city=False, recent=0):
     """Shows visitor summary, something like:
 
@@ -903,6 +1189,8 @@ def check_path(folder, args):
 
 
 def dbtool_main():
+    use_primary()
+
     parser = argparse.ArgumentParser(
         prog=__prog__,
         formatter_class=argparse.RawTextHelpFormatter,
@@ -935,6 +1223,12 @@ def dbtool_main():
             {__prog__} -f --remove 20220127
             {__prog__} --check-path /mnt/data/RaXPol/2022/202206*
             {__prog__} -u
+            {__prog__} --explain
+            {__prog__} --explain PX RAXPOL
+            {__prog__} --repack-sweeps
+            {__prog__} --repack-days
+            {__prog__} --partition
+            {__prog__} --partition --ahead 6
         """
         ),
         epilog="Copyright (c) 2021-2022 Boonleng Cheong",
@@ -953,11 +1247,13 @@ def dbtool_main():
              """
         ),
     )
+    parser.add_argument("--ahead", default=3, type=int, help="sets number of future months for --partition")
     parser.add_argument("--all", action="store_true", help="sets to use all for --visitor")
     parser.add_argument("-b", dest="hour", default=0, type=int, help="sets beginning hour of the day to catalog")
     parser.add_argument("-c", "--check-day", action="store_true", help="checks entries from the Day table")
     parser.add_argument("-C", "--check-sweep", action="store_true", help="checks entries from the Sweep table")
     parser.add_argument("-d", dest="build_day", action="store_true", help="builds a Day entry")
+    parser.add_argument("--explain", action="store_true", help="explains the hot queries and flags sequential scans")
     parser.add_argument("-f", "--find-duplicates", action="store_true", help="finds duplicate Sweep entries")
     parser.add_argument("--format", default="pretty", choices=["raw", "short", "pretty"], help="sets output format")
     parser.add_argument("-i", dest="insert", action="store_true", help="inserts a folder")
@@ -967,8 +1263,11 @@ def dbtool_main():
     parser.add_argument("--markdown", action="store_true", help="generates output in markdown")
     parser.add_argument("--no-bgor", dest="bgor", default=True, action="store_false", help="skips computing bgor")
     parser.add_argument("-p", "--check-path", action="store_true", help="checks the storage path")
+    parser.add_argument("--partition", action="store_true", help="partitions the Sweep table by month")
     parser.add_argument("--progress", action="store_true", help="shows progress bar")
     parser.add_argument("--prune", action="store_true", help="prunes the database")
+    parser.add_argument("--repack-days", action="store_true", help="repacks legacy Day.hourly_count (after migrate)")
+    parser.add_argument("--repack-sweeps", action="store_true", help="repacks legacy Sweep.tarinfo (before migrate)")
     parser.add_argument("-q", dest="quiet", action="store_true", help="runs the tool in silent mode (verbose = 0)")
     parser.add_argument("--recent", default=7, type=int, help="shows recent N days of entries")
     parser.add_argument("--remove", action="store_true", help="removes entries when combined with --find-duplicates")
@@ -1035,6 +1334,10 @@ def dbtool_main():
             return
         for day in args.source:
             build_day(day, bgor=True)
+    elif args.explain:
+        if args.markdown:
+            logger.hideLogOnScreen()
+        explain_queries(args.source, markdown=args.markdown)
     elif args.find_duplicates:
         if len(args.source) == 0:
             print(
@@ -1095,11 +1398,17 @@ def dbtool_main():
         if args.markdown:
             logger.hideLogOnScreen()
         check_latest(args.source, markdown=args.markdown)
+    elif args.partition:
+        partition_sweeps(ahead=args.ahead)
     elif args.prune:
         if len(args.source) == 0:
             args.source = "*"
         for source in args.source:
             check_source(source, remove=True)
+    elif args.repack_days:
+        repack_days()
+    elif args.repack_sweeps:
+        repack_sweeps()
     elif args.sweep:
         if args.markdown:
             logger.hideLogOnScreen()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+#
+#  bench-archives.py
+#  Latency of the archive views under many concurrent clients
+#
+#  Each client sends requests one after another, cycling through a mix of
+#  /data/month, /data/count, /data/table and /data/load. Run it against a server
+#  with "async": false and again with "async": true in settings.json to compare
+#  the sync and async views, e.g.,
+#
+#  python devtools/bench-archives.py -c 200 -n 20 --day 20241225-2300 http://localhost:8000
+#
+#  RadarHub
+#
+#  Created by Boonleng Cheong
+#
+
+import time
+import asyncio
+import argparse
+import urllib.parse
+import numpy as np
+
+
+async def fetch(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nAccept-Encoding: gzip\r\nConnection: close\r\n\r\n"
+    writer.write(request.encode("utf-8"))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    await writer.wait_closed()
+    return int(response[9:12]) if len(response) > 12 else 0
+
+
+async def client(host, port, paths, count, latencies, codes):
+    for k in range(count):
+        path = paths[k % len(paths)]
+        tic = time.perf_counter()
+        try:
+            code = await fetch(host, port, path)
+        except OSError:
+            code = 0
+        latencies.append(time.perf_counter() - tic)
+        codes[code] = codes.get(code, 0) + 1
+
+
+async def run(args):
+    url = urllib.parse.urlparse(args.url)
+    host, port = url.hostname, url.port or 80
+    day = args.day[:8]
+    paths = [
+        f"/data/month/{args.pathway}/{day[:6]}/",
+        f"/data/count/{args.pathway}/{day}/",
+        f"/data/table/{args.pathway}/{args.day}/",
+    ]
+    paths += [f"/data/load/{args.pathway}/{x}/" for x in args.locators]
+    latencies = []
+    codes = {}
+    tic = time.perf_counter()
+    tasks = [
+        client(host, port, paths[k % len(paths) :] + paths, args.count, latencies, codes) for k in range(args.clients)
+    ]
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - tic
+    latencies = np.array(latencies) * 1.0e3
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    print(f"| Clients | Requests | Elapsed (s) | Req/s | p50 (ms) | p90 (ms) | p99 (ms) | Max (ms) |")
+    print(f"|---|---|---|---|---|---|---|---|")
+    print(
+        f"| {args.clients} | {len(latencies)} | {elapsed:.2f} | {len(latencies) / elapsed:.1f} "
+        f"| {p50:.1f} | {p90:.1f} | {p99:.1f} | {latencies.max():.1f} |"
+    )
+    print(f"Status codes: {codes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency of the archive views under concurrent clients")
+    parser.add_argument(
+        "url", nargs="?", default="http://localhost:8000", help="server (default = http://localhost:8000)"
+    )
+    parser.add_argument(
+        "-c", dest="clients", default=200, type=int, help="number of concurrent clients (default = 200)"
+    )
+    parser.add_argument("-n", dest="count", default=20, type=int, help="requests per client (default = 20)")
+    parser.add_argument("--pathway", default="px1000", help="pathway (default = px1000)")
+    parser.add_argument("--day", default="20241225-2300", help="day and hour, YYYYMMDD-HHMM (default = 20241225-2300)")
+    parser.add_argument(
+        "--locators",
+        nargs="*",
+        default=["20241225-235939-E4.0-Z", "20241225-235939-E4.0-V"],
+        help="locators for /data/load",
+    )
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+###
+
+if __name__ == "__main__":
+    main()
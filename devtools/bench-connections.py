@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+#
+#  bench-connections.py
+#  Connection overhead of the archive queries
+#
+#  Each worker thread runs "requests" of one small Day query, wrapped in
+#  close_old_connections() the way Django wraps a request. With CONN_MAX_AGE = 0,
+#  every request connects to the database, with CONN_MAX_AGE > 0 the connection is
+#  reused. With a pool, CONN_MAX_AGE = 0 takes a connection from the pool. Runs
+#  against "data" and, if configured, "replica", e.g.,
+#
+#  python devtools/bench-connections.py -t 8 -n 200
+#
+#  RadarHub
+#
+#  Created by Boonleng Cheong
+#
+
+import os
+import sys
+import time
+import django
+import argparse
+import numpy as np
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "radarhub.settings")
+django.setup()
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from frontend.models import Day
+
+
+def worker(alias, count):
+    latencies = []
+    for _ in range(count):
+        tic = time.perf_counter()
+        close_old_connections()
+        Day.objects.using(alias).filter(name="PX").order_by("-date").first()
+        close_old_connections()
+        latencies.append(time.perf_counter() - tic)
+    connections[alias].close()
+    return latencies
+
+
+def run(alias, conn_max_age, threads, count):
+    # Connections are created with the settings of the alias, so this applies to the new ones
+    settings.DATABASES[alias]["CONN_MAX_AGE"] = conn_max_age
+    connections.close_all()
+    tic = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        results = executor.map(worker, [alias] * threads, [count] * threads)
+        latencies = np.concatenate([np.array(x) for x in results]) * 1.0e3
+    elapsed = time.perf_counter() - tic
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    print(
+        f"| {alias} | {conn_max_age} | {len(latencies)} | {len(latencies) / elapsed:.1f} "
+        f"| {p50:.2f} | {p90:.2f} | {p99:.2f} |"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connection overhead of the archive queries")
+    parser.add_argument("-t", dest="threads", default=8, type=int, help="number of threads (default = 8)")
+    parser.add_argument("-n", dest="count", default=200, type=int, help="requests per thread (default = 200)")
+    args = parser.parse_args()
+
+    aliases = [x for x in ["data", "replica"] if x in settings.DATABASES]
+    pool = {x: settings.DATABASES[x].get("OPTIONS", {}).get("pool") for x in aliases}
+    print(f"Pool: {pool}")
+    print("| Alias | CONN_MAX_AGE | Requests | Req/s | p50 (ms) | p90 (ms) | p99 (ms) |")
+    print("|---|---|---|---|---|---|---|")
+    for alias in aliases:
+        # A pool hands out its connections with CONN_MAX_AGE = 0
+        for conn_max_age in [0] if pool[alias] else [0, 600]:
+            run(alias, conn_max_age, args.threads, args.count)
+
+
+###
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+#
+#  bench-val2ind.py
+#  Micro-benchmark of frontend.models.val2ind()
+#
+#  Compares the current val2ind(), with and without preallocated arrays,
+#  against the previous implementation (val2ind_v1) on 360 x 1000 and
+#  720 x 2000 sweeps of every symbol
+#
+#  Usage: python devtools/bench-val2ind.py [-n 50]
+#
+#  RadarHub
+#
+#  Created by Boonleng Cheong
+#
+
+import os
+import sys
+import time
+import django
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "radarhub.settings")
+django.setup()
+
+from frontend.models import val2ind
+
+ranges = {
+    "Z": (-40.0, 90.0),
+    "V": (-70.0, 70.0),
+    "W": (0.0, 14.0),
+    "D": (-12.0, 15.0),
+    "P": (-190.0, 190.0),
+    "R": (-0.2, 1.2),
+    "I": (0.0, 6.0),
+}
+
+
+def val2ind_v1(v, symbol="Z"):
+    def rho2ind(x):
+        m3 = x > 0.93
+        m2 = np.logical_and(x > 0.7, ~m3)
+        index = x * 52.8751
+        index[m2] = x[m2] * 300.0 - 173.0
+        index[m3] = x[m3] * 1000.0 - 824.0
+        return index
+
+    if symbol == "Z":
+        u8 = v * 2.0 + 64.0
+    elif symbol == "V":
+        u8 = v * 2.0 + 128.0
+    elif symbol == "W":
+        u8 = v * 20.0
+    elif symbol == "D":
+        u8 = v * 10.0 + 100.0
+    elif symbol == "P":
+        u8 = v * 128.0 / 180.0 + 128.0
+    elif symbol == "R":
+        u8 = rho2ind(v)
+    elif symbol == "I":
+        u8 = (v - 0.5) * 42 + 46
+    else:
+        u8 = v
+    return np.nan_to_num(np.clip(np.round(u8), 1.0, 255.0), copy=False).astype(np.uint8)
+
+
+def timeit(func, count):
+    tic = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - tic) / count * 1.0e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of val2ind()")
+    parser.add_argument("-n", dest="count", default=50, type=int, help="number of repetitions (default = 50)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    np.seterr(invalid="ignore")
+
+    print("| Shape | Symbol | v1 (ms) | val2ind (ms) | val2ind + out (ms) | Speedup | Identical |")
+    print("|---|---|---|---|---|---|---|")
+    for shape in [(360, 1000), (720, 2000)]:
+        out = np.empty(shape, dtype=np.uint8)
+        work = np.empty(shape, dtype=np.float32)
+        for symbol, (lo, hi) in ranges.items():
+            # About 40% of the gates are not finite, like a typical sweep
+            values = rng.uniform(lo, hi, shape).astype(np.float32)
+            values[rng.random(shape) < 0.4] = np.nan
+            same = np.array_equal(val2ind_v1(values, symbol), val2ind(values, symbol))
+            t1 = timeit(lambda: val2ind_v1(values, symbol), args.count)
+            t2 = timeit(lambda: val2ind(values, symbol), args.count)
+            t3 = timeit(lambda: val2ind(values, symbol, out=out, work=work), args.count)
+            print(f"| {shape} | {symbol} | {t1:.2f} | {t2:.2f} | {t3:.2f} | {t1 / t3:.1f}x | {same} |")
+
+
+###
+
+if __name__ == "__main__":
+    main()
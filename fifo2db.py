@@ -11,8 +11,11 @@
 import os
 import sys
 import glob
+import json
 import radar
 import django
+import struct
+import asyncio
 import select
 import signal
 import socket
@@ -20,17 +23,25 @@ import logging
 import argparse
 import datetime
 import textwrap
+import ctypes.util
 import threading
+import collections
+import concurrent.futures
 import time as tm
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "radarhub.settings")
 django.setup()
 
-from dbtool import build_day, xz_folder
+from radarhub.dbrouter import use_primary
+
+use_primary()
+
+from dbtool import build_day
 
 from django.conf import settings
+from frontend import sidecar
 from frontend.models import Sweep, Day
-from common import colorize, colored_variables
+from common import colorize, colored_variables, pretty_object_name
 from common import check, ignore, missing, processed, log_format
 
 __prog__ = os.path.splitext(os.path.basename(sys.argv[0]))[0]
@@ -47,7 +58,110 @@ for item in radars.values():
     item["step"] = 0
     item["count"] = 0
 
-datashop = radar.product.Client(n=1, host="localhost", port=50000)
+datashop = None
+
+
+def datashop_options(workers):
+    # One datashop connection per worker, the keyword of radar.product.Client is count
+    return {"count": workers, "host": "localhost", "port": 50000}
+
+
+class DayScheduler:
+    """
+    Updates the Day entries of the ingested sweeps in the background
+
+    - `delay` : quiet time (s) after the last sweep of a day before its Day entry is updated
+    - `max_delay` : longest time (s) a day waits during a continuous burst
+
+    Ingest only marks (name, date) as dirty with the hours of the new sweeps, so a burst
+    of files of the same day ends up as one build_day() call, and the bgor summary, which
+    decodes many sweeps, no longer holds up the ingest. Since build_day() recounts the day
+    from the Sweep table with one GROUP BY query, a failed or missed update is repaired by
+    the next one, and a day that fails is marked again for a retry
+
+    Methods:
+    - `mark(name, time, bgor=False)` : marks the day of a new sweep as dirty
+    - `depth` : number of days waiting to be updated
+    - `stop()` : updates the remaining days and stops the thread
+    """
+
+    def __init__(self, delay=2.0, max_delay=30.0):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.dirty = {}
+        self.wakeup = threading.Event()
+        self.active = True
+        self.updates = 0
+        self.thread = threading.Thread(target=self._runloop, daemon=True)
+        self.thread.start()
+
+    @property
+    def depth(self):
+        with self.lock:
+            return len(self.dirty)
+
+    def mark(self, name, time, bgor=False):
+        now = tm.time()
+        with self.lock:
+            key = (name, time.date())
+            entry = self.dirty.setdefault(
+                key, {"first": now, "last": now, "hours": collections.Counter(), "bgor": False}
+            )
+            entry["last"] = now
+            entry["hours"][time.hour] += 1
+            entry["bgor"] |= bgor
+        self.wakeup.set()
+
+    def _due(self, flush=False):
+        now = tm.time()
+        with self.lock:
+            keys = [
+                k
+                for k, v in self.dirty.items()
+                if flush or now - v["last"] >= self.delay or now - v["first"] >= self.max_delay
+            ]
+            return [(k, self.dirty.pop(k)) for k in keys]
+
+    def _retry(self, key, entry):
+        with self.lock:
+            dirty = self.dirty.setdefault(key, entry)
+            if dirty is not entry:
+                dirty["first"] = min(dirty["first"], entry["first"])
+                dirty["hours"].update(entry["hours"])
+                dirty["bgor"] |= entry["bgor"]
+
+    def _update(self, flush=False):
+        myname = colorize("DayScheduler", "green")
+        for (name, date), entry in self._due(flush):
+            tic = tm.time()
+            try:
+                build_day(f"{name}-{date.strftime(r'%Y%m%d')}", bgor=entry["bgor"])
+            except Exception as e:
+                logger.error(f"{myname} {name}-{date} {e}")
+                if not flush:
+                    self._retry((name, date), entry)
+                continue
+            self.updates += 1
+            count = sum(entry["hours"].values())
+            depth = self.depth
+            elapsed = tm.time() - tic
+            logger.info(f"{myname}   {colored_variables(name, date, count, depth)}   {elapsed:.3f} s")
+
+    def _runloop(self):
+        while self.active:
+            self.wakeup.wait(timeout=self.delay)
+            self.wakeup.clear()
+            self._update()
+
+    def stop(self):
+        self.active = False
+        self.wakeup.set()
+        self.thread.join()
+        self._update(flush=True)
+
+
+scheduler = None
 
 
 def signalHandler(sig, frame):
@@ -85,61 +199,167 @@ def proper(file, root="/mnt/data", verbose=0):
     return filename
 
 
-def catchup(root="/mnt/data"):
-    global radars
+class Checkpoint:
+    """
+    High-water mark of the ingest of each radar, i.e., the time and path of the latest sweep,
+    persisted as JSON so that catchup() knows where to resume after a restart
+
+    - `file` : path of the JSON file
+    - `interval` : shortest time (s) between two writes of the file
+
+    Methods:
+    - `get(name)` : returns (time, path) of a radar prefix, or (None, None)
+    - `update(name, time, path)` : moves the mark forward, older sweeps do not move it back
+    - `save()` : writes the file now
+    """
+
+    def __init__(self, file, interval=5.0):
+        self.file = file
+        self.interval = interval
+        self.saved = 0.0
+        self.marks = {}
+        if os.path.exists(file):
+            try:
+                with open(file) as fid:
+                    self.marks = json.load(fid)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Unable to read {file} ({e}), starting afresh")
+
+    def get(self, name):
+        mark = self.marks.get(name)
+        if mark is None:
+            return None, None
+        return datetime.datetime.fromisoformat(mark["time"]), mark["path"]
+
+    def update(self, name, time, path):
+        last, _ = self.get(name)
+        if last is not None and time <= last:
+            return
+        self.marks[name] = {"time": time.isoformat(), "path": path}
+        if tm.time() - self.saved >= self.interval:
+            self.save()
+
+    def save(self):
+        tmp = f"{self.file}.tmp"
+        with open(tmp, "w") as fid:
+            json.dump(self.marks, fid, indent=1)
+        os.replace(tmp, self.file)
+        self.saved = tm.time()
+
+
+checkpoint = None
+
+
+def list_archives(folder):
+    """
+    Returns the archives of a day folder, in _original/ or the folder itself, as a list of
+    (time, path) sorted by time
+    """
+    files = []
+    for sub in [f"{folder}/_original", folder]:
+        if not os.path.isdir(sub):
+            continue
+        for entry in os.scandir(sub):
+            if entry.name.startswith(".") or not entry.name.endswith((".tar.xz", ".txz")):
+                continue
+            parts = radar.re_3parts.search(entry.name)
+            if parts is None:
+                continue
+            time = datetime.datetime.strptime(parts["time"], r"%Y%m%d-%H%M%S").replace(tzinfo=tzinfo)
+            files.append((time, entry.path))
+    return sorted(files)
+
+
+def find_gaps(files, times):
+    """
+    Sorted-merge difference of the archives and the Sweep entries
+
+    - files - list of (time, path) of the archives, sorted by time
+    - times - times of the Sweep entries, sorted
+
+    Returns the paths of the archives without a Sweep entry
+    """
+    gaps = []
+    k = 0
+    for time, path in files:
+        while k < len(times) and times[k] < time:
+            k += 1
+        if k < len(times) and times[k] == time:
+            continue
+        gaps.append(path)
+    return gaps
+
+
+def catchup(root="/mnt/data", lookback=1, batch=100):
+    """
+    Ingests the archives that arrived while fifo2db was not running
+
+    - root - root of the data, e.g., /mnt/data
+    - lookback - number of days before the checkpoint to check for gaps
+    - batch - number of files in each process_batch()
+
+    From the checkpoint of each radar (or its latest Day entry) to today, the archives of each
+    day folder are compared with the Sweep entries of the day, one listing and one query per
+    day, and only the missing archives are read
+    """
     myname = colorize("catchup()", "green")
+    today = datetime.datetime.now(tzinfo).date()
     for item in radars.values():
         prefix = item["prefix"]
         folder = f"{root}/{item['folder']}"
         show = f"{myname}   {colored_variables(prefix, folder)}"
-        if not Day.objects.filter(name=prefix).exists():
-            logger.info(f"{show}   {check}")
-            continue
-        elif not os.path.isdir(folder):
+        if not os.path.isdir(folder):
             logger.info(f"{show}   {missing}")
             continue
-        logger.info(f"{show}   {processed}")
-        folderYear = sorted(glob.glob(f"{folder}/20[0-9][0-9]"))[-1]
-        year = os.path.basename(folderYear)
-        path = f"{folderYear}/{year}[012][0-9][0-3][0-9]"
-        folderYearDay = sorted(glob.glob(path))[-1]
-        day = os.path.basename(folderYearDay)
-        logger.info(f"{folderYear} -> {year} -> {day}")
-        files = sorted(glob.glob(f"{folderYearDay}/_original/*.tar.xz"))
-        if len(files) == 0:
-            files = sorted(glob.glob(f"{folderYearDay}/*.txz"))
-        if len(files) == 0:
-            files = sorted(glob.glob(f"{folderYearDay}/_original/*.txz"))
-        if len(files) == 0:
-            logger.info("Error. No files.")
-            return
-        file = files[-1]
-        logger.info(f"{file}")
-        basename = os.path.basename(file)
-        c = basename.split("-")
-        d = c[1]
-        filedate = datetime.datetime.strptime(d, r"%Y%m%d").date()
-        day = Day.objects.filter(name=prefix).latest("date")
-        hour = day.last_hour
-        date = day.date
-        stride = datetime.timedelta(days=1)
-        while date <= filedate:
-            dayTree = date.strftime(r"%Y/%Y%m%d")
-            dayFolder = f"{folder}/{dayTree}"
-            logger.info(f"{myname}   {colored_variables(folder, hour)}")
-            xz_folder(dayFolder, hour=hour, skip=True)
-            date += stride
-            hour = 0
-        item["count"] += 1
-        minute = int(c[2][2:4])
-        step = minute // 20
-        item["step"] = 0 if step == 2 else step + 1
-        if logger.level > logging.WARNING:
-            print("")
+        time, path = checkpoint.get(prefix) if checkpoint else (None, None)
+        if time is None:
+            day = Day.objects.filter(name=prefix).order_by("date").last()
+            if day is None:
+                logger.info(f"{show}   {check}")
+                continue
+            date = day.date
+        else:
+            date = time.date()
+        logger.info(f"{show}   {colored_variables(date, path)}")
+        date -= datetime.timedelta(days=lookback)
+        total = 0
+        tic = tm.time()
+        while date <= today:
+            files = list_archives(f"{folder}/{date.strftime(r'%Y/%Y%m%d')}")
+            if files:
+                start = datetime.datetime(date.year, date.month, date.day, tzinfo=tzinfo)
+                sweeps = Sweep.objects.filter(time__range=[start, start + datetime.timedelta(days=1)], name=prefix)
+                times = list(sweeps.order_by("time").values_list("time", flat=True))
+                gaps = find_gaps(files, times)
+                if gaps:
+                    count = len(gaps)
+                    logger.info(f"{myname}   {colored_variables(prefix, date, count)}")
+                    for k in range(0, count, batch):
+                        process_batch(gaps[k : k + batch])
+                    total += count
+            date += datetime.timedelta(days=1)
+        logger.info(f"{myname}   {colored_variables(prefix, total)}   {tm.time() - tic:.2f} s")
 
 
-def process(source):
-    global radars
+catchup_root = None
+
+
+def recheck():
+    """
+    Catches up from the checkpoints once a source is (re)connected, for the archives that landed
+    before its announcements could queue up, i.e., during the initial catchup() or a disconnection.
+    Only the days since the checkpoints are listed, and the files that are also announced are
+    skipped by the existence checks
+    """
+    if catchup_root:
+        catchup(catchup_root, lookback=0)
+
+
+def parse(source):
+    """
+    Parses a source into a task of ingest, i.e., a dictionary of the file, name, time, scan and
+    the radar item of the file. Returns None if the file is not one to ingest
+    """
     if not os.path.exists(source):
         logger.debug(f"File {source} not found.")
         file = proper(source)
@@ -147,47 +367,255 @@ def process(source):
         file = source
     if file is None:
         logger.info(f"{colorize(source, 43)} {missing}")
-        return
+        return None
     basename = os.path.basename(file)
     parts = radar.re_3parts.search(basename)
     if parts is None:
         logger.error(f"Not a good file pattern. Ignoring {file} ...")
-        return
+        return None
     parts = parts.groupdict()
     name = parts["name"]
     item = next((x for x in radars.values() if x["prefix"] == name), None)
     if item is None:
         logger.info(f"{colorize(source, 43)} {ignore}")
-        return
+        return None
     time = datetime.datetime.strptime(parts["time"], r"%Y%m%d-%H%M%S").replace(tzinfo=tzinfo)
-    sweep = Sweep.objects.filter(time=time, name=name)
-    if sweep:
-        logger.debug(f"Sweep {name}-{time} exists.")
-        return
+    return {"source": source, "file": file, "name": name, "time": time, "scan": parts["scan"], "item": item}
+
+
+def extract(task):
+    """
+    Reads the file of a task through datashop and returns an unsaved Sweep, or None if the file
+    cannot be read. The decoded data is only kept until the gate counts and the sidecar payloads
+    are derived from it
+    """
+    file = task["file"]
     # data, tarinfo = radar.read(file, want_tarinfo=True)
     data, tarinfo = datashop.get(file, want_tarinfo=True)
     if data is None:
         logger.error(f"Failed opening file {file}")
-        return
+        return None
     if tarinfo is None:
         tarinfo = {}
     kind = data["kind"]
-    scan = parts["scan"]
     # symbols = list(data["products"].keys())
     symbols = " ".join(list(data["products"].keys()))
-    sweep = Sweep(time=time, name=name, kind=kind, scan=scan, symbols=symbols, path=file, tarinfo=tarinfo)
-    sweep.save()
-    logger.info(f"{colorize(source, 43)} {processed}")
+    sweep = Sweep(
+        time=task["time"], name=task["name"], kind=kind, scan=task["scan"], symbols=symbols, path=file, tarinfo=tarinfo
+    )
+    # Gate counts for Day.summarize() while the data is decoded
+    sweep.tally(data)
+
+    # Pre-render the payloads for /data/load while the data is decoded
+    if settings.SIDECAR:
+        tic = tm.time()
+        # The sidecar is optional, /data/load renders the payloads without it, so the sweep is kept
+        try:
+            count = sidecar.write(file, data)
+            logger.debug(f"Rendered {count} sidecar payloads in {tm.time() - tic:.3f} s")
+        except Exception as e:
+            logger.warning(f"Unable to render the sidecar payloads of {file} {e}")
+    return sweep
 
+
+def finish(task):
+    """
+    Book-keeping of a new Sweep entry, which must be called in the order of arrival
+    """
+    logger.info(f"{colorize(task['source'], 43)} {processed}")
+    item = task["item"]
+    time = task["time"]
     bgor = False
-    if scan.startswith(item["summary"]):
+    if task["scan"].startswith(item["summary"]):
         step = time.minute // 20
         target = item["step"]
         logger.debug(f"{step} vs {target}")
         if item["step"] == step:
             item["step"] = 0 if step == 2 else item["step"] + 1
             bgor = True
-    build_day(f"{name}-{time.strftime(r'%Y%m%d')}", bgor=bgor)
+    # Day entry is updated in the background, together with the other new sweeps of the day
+    scheduler.mark(task["name"], time, bgor=bgor)
+    if checkpoint:
+        checkpoint.update(task["name"], time, task["file"])
+
+
+def process(source):
+    task = parse(source)
+    if task is None:
+        return
+    name, time = task["name"], task["time"]
+    sweep = Sweep.objects.filter(time=time, name=name)
+    if sweep:
+        logger.debug(f"Sweep {name}-{time} exists.")
+        return
+    sweep = extract(task)
+    if sweep is None:
+        return
+    sweep.save()
+    finish(task)
+
+
+def process_batch(sources, wait=0.0):
+    """
+    Ingests a batch of sources with one existence query, concurrent extraction through the
+    datashop connections and one bulk_create()
+
+    - sources - list of sources, in the order of arrival
+    - wait - time (s) the first source has waited for the batch
+    """
+    myname = colorize("process_batch()", "green")
+    tic = tm.time()
+    tasks = {}
+    for source in sources:
+        task = parse(source)
+        if task:
+            tasks.setdefault((task["name"], task["time"]), task)
+    names = {name for name, _ in tasks}
+    times = [time for _, time in tasks]
+    existing = set(Sweep.objects.filter(name__in=names, time__in=times).values_list("name", "time")) if tasks else set()
+    tasks = [task for key, task in tasks.items() if key not in existing]
+    toc = tm.time()
+    sweeps = []
+    with concurrent.futures.ThreadPoolExecutor(datashop.count) as executor:
+        futures = [executor.submit(extract, task) for task in tasks]
+        # Each file on its own, a bad one must not take the others of the batch with it
+        for task, future in zip(tasks, futures):
+            try:
+                sweeps.append(future.result())
+            except Exception as e:
+                logger.error(f"Failed extracting {task['file']} {e}")
+                sweeps.append(None)
+    tasks, sweeps = [t for t, s in zip(tasks, sweeps) if s], [s for s in sweeps if s]
+    extract_time = tm.time() - toc
+    toc = tm.time()
+    Sweep.objects.bulk_create(sweeps)
+    insert_time = tm.time() - toc
+    for task in tasks:
+        finish(task)
+    elapsed = tm.time() - tic
+    count = len(sources)
+    created = len(sweeps)
+    show = colored_variables(count, created)
+    rate = count / elapsed if elapsed else 0.0
+    timing = f"extract {extract_time:.3f} s   insert {insert_time:.3f} s   latency {wait + elapsed:.3f} s"
+    logger.info(f"{myname}   {show}   {rate:,.1f} files / sec   {timing}")
+    return created
+
+
+class Batcher:
+    """
+    Collects the incoming sources for process_batch()
+
+    - `size` : largest number of sources in a batch
+    - `window` : longest time (s) the first source of a batch waits for the others
+
+    Methods:
+    - `add(source)` : adds a source, the batch is processed when it is full or its window has passed
+    - `poll()` : processes the batch when its window has passed, called by the readers when idle
+    - `flush()` : processes the batch now
+    """
+
+    def __init__(self, size=100, window=0.5):
+        self.size = size
+        self.window = window
+        self.sources = []
+        self.first = 0.0
+
+    def add(self, source):
+        if not self.sources:
+            self.first = tm.time()
+        self.sources.append(source)
+        # A steady stream never leaves the readers idle to poll(), so the window is checked here too
+        if len(self.sources) >= self.size or tm.time() - self.first >= self.window:
+            self.flush()
+
+    def poll(self):
+        if self.sources and tm.time() - self.first >= self.window:
+            self.flush()
+
+    def flush(self):
+        sources, self.sources = self.sources, []
+        if sources:
+            process_batch(sources, wait=tm.time() - self.first)
+
+
+class Pipeline:
+    """
+    Extracts the incoming sources on a bounded pool of workers and commits them in the order of arrival
+
+    - `workers` : number of workers, which should be the number of datashop connections
+    - `depth` : largest number of sources in flight, add() waits for the oldest beyond that
+
+    Only extract() runs on the workers. The existence checks, the saves and the book-keeping
+    of finish() stay on the reader thread, so item["step"] and the Day entries see the sweeps
+    in the same order as before
+
+    Methods:
+    - `add(source)` : submits a source to the workers
+    - `poll()` : commits the sources at the head of the queue that are extracted
+    - `flush()` : waits for all sources in flight and commits them
+    """
+
+    def __init__(self, workers=4, depth=None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.depth = depth or 2 * workers
+        self.pending = collections.deque()
+        self.inflight = set()
+
+    def add(self, source):
+        task = parse(source)
+        if task is None:
+            return
+        key = (task["name"], task["time"])
+        if key in self.inflight or Sweep.objects.filter(time=task["time"], name=task["name"]).exists():
+            logger.debug(f"Sweep {key[0]}-{key[1]} exists.")
+            return
+        self.inflight.add(key)
+        self.pending.append((task, self.executor.submit(extract, task)))
+        self.poll()
+        while len(self.pending) >= self.depth:
+            self._commit()
+
+    def _commit(self):
+        task, future = self.pending.popleft()
+        self.inflight.discard((task["name"], task["time"]))
+        try:
+            sweep = future.result()
+        except Exception as e:
+            logger.error(f"Failed extracting {task['file']} {e}")
+            return
+        if sweep is None:
+            return
+        sweep.save()
+        finish(task)
+
+    def poll(self):
+        while self.pending and self.pending[0][1].done():
+            self._commit()
+
+    def flush(self):
+        while self.pending:
+            self._commit()
+
+
+batcher = None
+pipeline = None
+
+
+def ingest(source):
+    if batcher:
+        batcher.add(source)
+    elif pipeline:
+        pipeline.add(source)
+    else:
+        process(source)
+
+
+def poll():
+    if batcher:
+        batcher.poll()
+    elif pipeline:
+        pipeline.poll()
 
 
 def listen(host="10.197.14.59", port: int = 9000):
@@ -213,10 +641,12 @@ def listen(host="10.197.14.59", port: int = 9000):
             continue
         sock.setblocking(0)
         logger.info(f"fifoshare connection {host} established")
+        recheck()
 
         localMemory = b""
 
         while keepReading:
+            poll()
             # Check if the socket is ready to read
             readyToRead, _, selectError = select.select([sock], [], [sock], 0.1)
             if selectError:
@@ -247,7 +677,7 @@ def listen(host="10.197.14.59", port: int = 9000):
                     continue
                 # At this point, the filename is considered good
                 file = os.path.expanduser(file)
-                process(file)
+                ingest(file)
 
         # Out of the second keepReading loop. Maybe there was an error in select(), close and retry
         sock.close()
@@ -296,8 +726,10 @@ def read(pipe="/tmp/radarhub.fifo"):
                 k -= 1
             continue
         logger.info(f"pipe {pipe} opened")
+        recheck()
 
         while keepReading:
+            poll()
             # Check if the fid is ready to read
             readyToRead, _, selectError = select.select([fid], [], [fid], 0.1)
             if selectError:
@@ -320,7 +752,7 @@ def read(pipe="/tmp/radarhub.fifo"):
                     continue
                 # At this point, the filename is considered good
                 file = os.path.expanduser(file)
-                process(file)
+                ingest(file)
 
         # Out of the second keepReading loop. Maybe there was an error in select(), close and retry
         fid.close()
@@ -332,6 +764,275 @@ def read(pipe="/tmp/radarhub.fifo"):
                 k -= 1
 
 
+async def subscribe(source, queue, port=9000):
+    """
+    Puts the filenames announced by a source into the shared queue, one per line
+
+    - source - "host:port" of a fifoshare server, or the path of a named pipe
+    - queue - the asyncio.Queue of all sources
+    - port - port of the fifoshare server if the source has none
+
+    Reconnects with an exponential backoff, from 1 s up to 30 s, without holding up the others
+    """
+    myname = pretty_object_name("subscribe", source)
+    backoff = 1.0
+    while keepReading:
+        stream = None
+        try:
+            if "/" in source:
+                if not os.path.exists(source):
+                    os.mkfifo(source)
+                # Opening for read and write keeps the pipe from reaching EOF when the writers come and go
+                reader = asyncio.StreamReader()
+                fid = os.fdopen(os.open(source, os.O_RDWR | os.O_NONBLOCK), "rb", buffering=0)
+                loop = asyncio.get_running_loop()
+                stream, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), fid)
+            else:
+                host, _, p = source.partition(":")
+                reader, stream = await asyncio.open_connection(host, int(p or port))
+            logger.info(f"{myname} connected")
+            # The consumer runs recheck() in turn, while the announcements queue up behind it
+            await queue.put(recheck)
+            backoff = 1.0
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                file = line.decode("ascii", errors="ignore").strip()
+                logger.debug(f"{myname} -> '{file}' ({len(file)})")
+                if file:
+                    await queue.put(os.path.expanduser(file))
+            logger.info(f"{myname} closed")
+        except (OSError, ValueError) as e:
+            logger.info(f"{myname} not available ({e}), retry in {backoff:.0f} s")
+        finally:
+            if stream:
+                stream.close()
+        await asyncio.sleep(backoff)
+        backoff = min(2.0 * backoff, 30.0)
+
+
+class Inotify:
+    """
+    Linux inotify through ctypes, for watch()
+
+    Methods:
+    - `add(folder, mask)` : watches a folder, returns the watch descriptor
+    - `remove(folder)` : stops watching a folder
+    - `read()` : returns the pending events as a list of (folder, name, mask)
+    - `close()` : closes the inotify instance
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+
+    # struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+    header = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.folders = {}
+
+    def add(self, folder, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), folder)
+        self.folders[wd] = folder
+        return wd
+
+    def remove(self, folder):
+        # The watch is forgotten on its IN_IGNORED event
+        for wd in [k for k, v in self.folders.items() if v == folder]:
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        k = 0
+        while k < len(buffer):
+            wd, mask, _, n = self.header.unpack_from(buffer, k)
+            k += self.header.size
+            name = buffer[k : k + n].rstrip(b"\0").decode("utf-8", errors="ignore")
+            k += n
+            if mask & self.IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            events.append((self.folders.get(wd), name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+async def watch(root, queue, settle=1.0, days=2):
+    """
+    Puts the archives that appear in the folders of the radars into the shared queue
+
+    - root - root of the data, e.g., /mnt/data
+    - queue - the asyncio.Queue of all sources
+    - settle - quiet time (s) after the last event of a file before it is queued
+    - days - number of the most recent day folders to watch, i.e., today and yesterday
+
+    Only the radar folders, the year folders and the recent day folders (and _original/ in them)
+    are watched, a handful per radar, so the number of watches stays well under
+    fs.inotify.max_user_watches. A file is taken on close-write, or moved-to since rsync renames
+    its temporary file at the end, and the events of a file are debounced until it settles. New
+    year and day folders are watched as they are created, and scanned once for the files that
+    arrived before the watch, while the day folders that are no longer recent are dropped
+    """
+    myname = pretty_object_name("watch", root)
+    inotify = Inotify()
+    mask = Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_CREATE
+    pending = {}
+    # Folder -> (level, day), level 0 = radar, 1 = year, 2 = day, 3 = inside a day, e.g., _original
+    levels = {}
+
+    def _is_archive(name):
+        return not name.startswith(".") and name.endswith((".tar.xz", ".txz"))
+
+    def _recent():
+        today = datetime.datetime.now(tz=tzinfo).date()
+        return {(today - datetime.timedelta(days=k)).strftime(r"%Y%m%d") for k in range(days)}
+
+    def _add(folder, level, day=None, scan=False):
+        # A folder may be removed or unreadable by now, which must not end the task
+        try:
+            inotify.add(folder, mask)
+            levels[folder] = (level, day)
+            entries = list(os.scandir(folder))
+        except OSError as e:
+            logger.warning(f"{myname} Unable to watch {folder} ({e})")
+            return
+        recent = _recent()
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                # Only the year and day folders of the recent days, everything inside a day
+                if level == 0 and entry.name not in {x[:4] for x in recent}:
+                    continue
+                if level == 1 and entry.name not in recent:
+                    continue
+                _add(entry.path, level + 1, day=entry.name if level == 1 else day, scan=scan)
+            elif scan and _is_archive(entry.name):
+                pending[entry.path] = tm.time()
+
+    def _prune():
+        recent = _recent()
+        for folder in [k for k, (level, day) in levels.items() if level >= 2 and day not in recent]:
+            inotify.remove(folder)
+            del levels[folder]
+
+    for item in radars.values():
+        folder = f"{root}/{item['folder']}"
+        if not os.path.isdir(folder):
+            logger.info(f"{myname} {folder} {missing}")
+            continue
+        _add(folder, 0)
+    count = len(inotify.folders)
+    logger.info(f"{myname}   {colored_variables(count)}")
+    # The archives that landed before the watches were in place, see recheck()
+    await queue.put(recheck)
+
+    loop = asyncio.get_running_loop()
+    readable = asyncio.Event()
+    loop.add_reader(inotify.fd, readable.set)
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(readable.wait(), settle / 4)
+            except asyncio.TimeoutError:
+                pass
+            readable.clear()
+            for folder, name, event in inotify.read():
+                if event & Inotify.IN_Q_OVERFLOW:
+                    logger.warning(f"{myname} Event queue overflowed, some files may be missed")
+                    continue
+                path = os.path.join(folder, name)
+                if event & Inotify.IN_ISDIR:
+                    if event & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO) and folder in levels:
+                        # Files that land before the watch is in place are picked up by the scan
+                        level, day = levels[folder]
+                        _add(path, level + 1, day=name if level == 1 else day, scan=True)
+                        if level == 1:
+                            _prune()
+                elif _is_archive(name) and event & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                    pending[path] = tm.time()
+            now = tm.time()
+            for path in [k for k, v in pending.items() if now - v >= settle]:
+                del pending[path]
+                logger.debug(f"{myname} -> {path}")
+                await queue.put(path)
+    finally:
+        loop.remove_reader(inotify.fd)
+        inotify.close()
+
+
+async def consume(queue):
+    myname = colorize("consume()", "green")
+    loop = asyncio.get_running_loop()
+    # All the database work stays on one thread, as with listen() and read()
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    while keepReading or not queue.empty():
+        try:
+            file = await asyncio.wait_for(queue.get(), 0.1)
+        except asyncio.TimeoutError:
+            file = None
+        # A bad file, or batch, must not stop the consumer while the sources keep filling the queue
+        try:
+            if file is None:
+                await loop.run_in_executor(executor, poll)
+            elif file is recheck:
+                await loop.run_in_executor(executor, recheck)
+            else:
+                await loop.run_in_executor(executor, ingest, file)
+        except Exception as e:
+            logger.error(f"{myname} {file} {e}")
+    executor.shutdown()
+
+
+async def serve(sources, port=9000, root=None):
+    """
+    Ingests the files announced by many sources, TCP and pipes, in one process
+
+    - sources - list of "host:port" of fifoshare servers and paths of named pipes
+    - port - port of the fifoshare servers without one
+    - root - root of the data to watch for new archives, e.g., /mnt/data, see watch()
+    """
+    myname = colorize("serve()", "green")
+    logger.info(f"{myname}   {colored_variables(sources, port, root)}")
+    queue = asyncio.Queue(maxsize=1000)
+    tasks = [asyncio.create_task(subscribe(source, queue, port=port)) for source in sources]
+    if root:
+        tasks.append(asyncio.create_task(watch(root, queue)))
+    consumer = asyncio.create_task(consume(queue))
+    while keepReading and not consumer.done():
+        await asyncio.sleep(0.1)
+    if keepReading:
+        # Nothing is ingested without the consumer, so stop rather than fill the queue
+        logger.error(f"{myname} Consumer stopped unexpectedly {consumer.exception()}")
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.gather(consumer, return_exceptions=True)
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog=__prog__,
@@ -344,11 +1045,22 @@ def main():
             {__prog__} -v
             {__prog__} 10.197.14.59
             {__prog__} -p /tmp/radarhub.fifo
+            {__prog__} --batch 100 --window 0.5 10.197.14.59
+            {__prog__} --workers 8 10.197.14.59
+            {__prog__} 10.197.14.59:9000 10.197.14.60:9000 /tmp/radarhub.fifo
+            {__prog__} -w
+            {__prog__} -w /mnt/data 10.197.14.59:9000
         """
         ),
         epilog="Copyright (c) Boonleng Cheong",
     )
-    parser.add_argument("source", default=None, type=str, nargs="?", help="source to retrieve files")
+    parser.add_argument("source", default=None, type=str, nargs="*", help="source(s) to retrieve files")
+    parser.add_argument("-a", dest="asyncio", action="store_true", help="uses asyncio even for a single source")
+    parser.add_argument("--batch", default=0, type=int, help="ingests in batches of up to N files (default = 0, off)")
+    parser.add_argument(
+        "--lookback", default=1, type=int, help="sets days before the checkpoint to check (default = 1)"
+    )
+    parser.add_argument("--no-catchup", dest="catchup", action="store_false", help="skips ingesting missed files")
     parser.add_argument("--port", default=9000, type=int, help="sets the port (default = 9000)")
     parser.add_argument("-p", dest="pipe", action="store_true", help="reads from a pipe")
     parser.add_argument(
@@ -361,29 +1073,51 @@ def main():
             runs a test
             1 - Test handling a corrupted tar archive
             2 - Test catching an exception
+            3 - Test catching up with the checkpoint
             """
         ),
     )
     parser.add_argument("--version", action="version", version="%(prog)s " + settings.VERSION)
     parser.add_argument("-v", dest="verbose", default=0, action="count", help="increases verbosity")
+    parser.add_argument(
+        "-w",
+        dest="watch",
+        nargs="?",
+        const="/mnt/data",
+        default=None,
+        help="watches the radar folders (default = /mnt/data)",
+    )
+    parser.add_argument("--window", default=0.5, type=float, help="sets the batch window in seconds (default = 0.5)")
+    parser.add_argument("--workers", default=4, type=int, help="sets the workers / datashop connections (default = 4)")
     args = parser.parse_args()
 
     # Set logger level to INFO by default
     logging.basicConfig(format=log_format, level=logging.DEBUG if args.verbose else logging.INFO)
 
-    # Populate the default source if not specified
-    if args.source is None:
-        if "tcp" in settings.FIFO:
-            args.source = settings.FIFO["tcp"]
-        elif "pipe" in settings.FIFO:
-            args.source = settings.FIFO["pipe"]
-            args.pipe = True
-        else:
-            args.source = "10.197.14.52:9000"
-    if ":" in args.source:
+    # Populate the default sources if not specified, watching the folders alone needs none
+    if len(args.source) == 0 and args.watch is None:
+        for key in ["tcp", "pipe"]:
+            value = settings.FIFO.get(key, [])
+            args.source += [value] if isinstance(value, str) else value
+        if len(args.source) == 0:
+            args.source = ["10.197.14.52:9000"]
+    sources = args.source
+    args.source = sources[0] if sources else ""
+    if "/" in args.source:
+        args.pipe = True
+    elif ":" in args.source:
         args.source, args.port = args.source.split(":")
         args.port = int(args.port)
 
+    global datashop, scheduler, batcher, pipeline, checkpoint, catchup_root
+    datashop = radar.product.Client(**datashop_options(args.workers))
+    scheduler = DayScheduler()
+    checkpoint = Checkpoint(settings.DATABASE_DIR / "fifo2db-checkpoint.json")
+    if args.batch > 0:
+        batcher = Batcher(size=args.batch, window=args.window)
+    elif args.workers > 1:
+        pipeline = Pipeline(workers=args.workers)
+
     if args.test > 0:
         if args.test == 1:
             logger.info("Test 1: Handling a corrupted archive")
@@ -396,19 +1130,34 @@ def main():
             print(f"Unable to generate {s}")
             return
         elif args.test == 3:
-            catchup()
+            catchup(args.watch or "/mnt/data", lookback=args.lookback)
+            checkpoint.save()
             return
         else:
             print("Unknown test")
             return
 
-    # catchup()
+    if args.catchup:
+        catchup(args.watch or "/mnt/data", lookback=args.lookback)
+        # Once more from the checkpoints when the sources are connected, see recheck()
+        catchup_root = args.watch or "/mnt/data"
 
-    if args.pipe:
+    if args.asyncio or args.watch or len(sources) > 1:
+        asyncio.run(serve(sources, port=args.port, root=args.watch))
+    elif args.pipe:
         read(args.source)
     else:
         listen(args.source, port=args.port)
 
+    if batcher:
+        batcher.flush()
+    elif pipeline:
+        pipeline.flush()
+
+    logger.info(f"Updating {scheduler.depth} remaining Day entries ...")
+    scheduler.stop()
+    checkpoint.save()
+
     logger.info("--- Finished ---")
 
 
@@ -1,19 +1,30 @@
+import os
 import re
 import json
+import asyncio
+import functools
+import radar
+import struct
+import hashlib
 import time
 import pprint
-import struct
 import logging
 import datetime
 import threading
 import multiprocessing
-import numpy as np
+import concurrent.futures
 
 from django.conf import settings
-from django.http import HttpResponse, Http404, HttpResponseForbidden
+from django.db import close_old_connections, router
+from django.http import HttpResponse, Http404, HttpResponseForbidden, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django.views.decorators.cache import never_cache
 
+from .cache import make_payload_cache, read_catchup, catchup_max_age
 from .models import Day, Sweep
+from .payload import compress, default_gates, lod, negotiate, pack
+from . import sidecar
 from common import colorize, colored_variables, is_valid_time, get_client_ip
 
 logger = logging.getLogger("frontend")
@@ -26,6 +37,11 @@ task_queue = multiprocessing.Queue()
 data_queue = multiprocessing.Queue()
 worker_run = multiprocessing.Value("i", 1)
 agg_output = {}
+payload_cache = make_payload_cache(settings.PAYLOAD_CACHE)
+month_cache = {}
+# Months dropped from month_cache by cache.invalidate_month(), refilled from the primary
+month_stale = set()
+catchup_snapshots = {}
 
 pp = pprint.PrettyPrinter(indent=1, depth=3, width=80, sort_dicts=False)
 
@@ -73,6 +89,39 @@ def is_dirty_request(request):
     return False
 
 
+def make_etag(*parts):
+    digest = hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=12).hexdigest()
+    return quote_etag(digest)
+
+
+def set_validators(response, etag, last_modified=None):
+    response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+"""
+    Conditional GET - returns a 304 response if the copy of the client is still valid, None otherwise
+
+    request - the request, which may carry If-None-Match / If-Modified-Since
+    etag - the validator of the content, see make_etag()
+    last_modified - modification time of the content in seconds since the epoch, optional
+
+    The validators are derived from the database rows (or the archive) the content is
+    made of, so a 304 answer does not need the content to be generated
+"""
+
+
+def not_modified(request, etag, last_modified=None):
+    if isinstance(request, str):
+        return None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
 def stat(request, mode="alive"):
     if is_dirty_request(request):
         return forbidden_request
@@ -91,24 +140,44 @@ def stat(request, mode="alive"):
 
     day - a string in the forms of
           - YYYYMM
+
+    The month is read in one query and kept in month_cache, keyed by prefix-YYYYMM,
+    until build_day() writes a Day entry of the month (see cache.invalidate_month()).
+    An invalidated month is refilled from the primary, since the replica may not have
+    the new Day entry yet and the stale counts would be cached until the next update
 """
 
 
 def _month(prefix, day):
+    key = f"{prefix}-{day[:6]}"
+    array = month_cache.get(key, None)
+    if array is not None:
+        return array
     y = int(day[0:4])
     m = int(day[4:6])
-    entries = Day.objects.filter(date__year=y, date__month=m, name=prefix)
     date = datetime.date(y, m, 1)
     step = datetime.timedelta(days=1)
     array = {}
     while date.month == m:
-        key = date.strftime(r"%Y%m%d")
-        entry = entries.filter(date=date).last()
-        array[key] = entry.weather_condition() if entry else 0
+        array[date.strftime(r"%Y%m%d")] = 0
         date += step
+    # Ordered by id so that the last entry of a date wins, like filter(date=date).last()
+    entries = Day.objects.filter(date__range=[datetime.date(y, m, 1), date - step], name=prefix).order_by("id")
+    stale = key in month_stale
+    if stale:
+        entries = entries.using(router.db_for_write(Day))
+    for entry in entries:
+        array[entry.date.strftime(r"%Y%m%d")] = entry.weather_condition()
+    month_cache[key] = array
+    if stale:
+        month_stale.discard(key)
     return array
 
 
+def _month_etag(prefix, day):
+    return make_etag("month", prefix, day, *_month(prefix, day).items())
+
+
 def month(request, pathway, day):
     if settings.VERBOSE > 1:
         myname = colorize("archive.month()", "green")
@@ -118,9 +187,15 @@ def month(request, pathway, day):
     if pathway == "undefined" or pathway not in settings.RADARS or day == "undefined" or re_yyyymm.match(day) is None:
         return invalid_query
     prefix = settings.RADARS[pathway]["prefix"]
+    etag = _month_etag(prefix, day)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
     array = _month(prefix, day)
     payload = json.dumps(array, separators=(",", ":"))
-    return HttpResponse(payload, content_type="application/json")
+    response = HttpResponse(payload, content_type="application/json")
+    response["Cache-Control"] = "no-cache"
+    return set_validators(response, etag)
 
 
 # region Count
@@ -144,10 +219,20 @@ def _count(prefix, day):
     d = Day.objects.filter(date=date, name=prefix)
     if d:
         d = d[0]
-        return [int(n) for n in d.hourly_count.split(",")]
+        return list(d.hourly_count)
     return [0] * 24
 
 
+def _days_etag(kind, prefix, day, neighbors=0):
+    # count() depends only on the hourly_count of the day, table() also looks into
+    # the adjacent days through _hour_offset_has_data()
+    date = datetime.datetime.strptime(day[:8], r"%Y%m%d").date()
+    step = datetime.timedelta(days=neighbors)
+    entries = Day.objects.filter(date__range=[date - step, date + step], name=prefix).order_by("date")
+    rows = entries.values_list("date", "hourly_count")
+    return make_etag(kind, prefix, day, *rows)
+
+
 def count(request, pathway, day):
     if settings.VERBOSE > 1:
         myname = colorize("archive.count()", "green")
@@ -158,9 +243,15 @@ def count(request, pathway, day):
     if pathway == "undefined" or pathway not in settings.RADARS or day == "undefined" or not is_valid_time(day):
         return invalid_query
     prefix = settings.RADARS[pathway]["prefix"]
+    etag = _days_etag("count", prefix, day)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
     data = {"count": _count(prefix, day)}
     payload = json.dumps(data, separators=(",", ":"))
-    return HttpResponse(payload, content_type="application/json")
+    response = HttpResponse(payload, content_type="application/json")
+    response["Cache-Control"] = "no-cache"
+    return set_validators(response, etag)
 
 
 def _hour_offset_has_data(prefix, day_hour, hour_offset):
@@ -176,7 +267,7 @@ def _hour_offset_has_data(prefix, day_hour, hour_offset):
     days = Day.objects.filter(date=date, name=prefix)
     if days:
         hour = s.tm_hour
-        return days.first().hourly_count.split(",")[hour] != "0"
+        return days.first().hourly_count[hour] != 0
     return False
 
 
@@ -248,6 +339,10 @@ def table(request, pathway, day_hour):
     if not re_yyyymmdd.match(day):
         logger.warning(f"Invalid day = {day} <- {day_hour}")
         return invalid_query
+    etag = _days_etag("table", prefix, day_hour, neighbors=1)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
     hourly_count = _count(prefix, day)
     if len(c) > 1:
         hour = int(c[1][:2])
@@ -273,7 +368,9 @@ def table(request, pathway, day_hour):
     data = {"hoursActive": _count(prefix, day), "hour": hour, "message": message}
     data = {**data, **add}
     payload = json.dumps(data, separators=(",", ":"))
-    return HttpResponse(payload, content_type="application/json")
+    response = HttpResponse(payload, content_type="application/json")
+    response["Cache-Control"] = "no-cache"
+    return set_validators(response, etag)
 
 
 # region Display
@@ -282,10 +379,45 @@ def table(request, pathway, day_hour):
     load_display_data_by_source_string
 
     source_string - the source of the sweep, e.g., PX-20230616-020024-E2.6-Z
+
+    The payload of an archived sweep does not change, so it is kept in
+    payload_cache, keyed by the source string. If the payload was pre-rendered
+    at ingest (settings.SIDECAR), it is read from the file without decoding
+
+    gates - maximum number of gates (level of detail), see payload.lod(). Other
+            levels than the default are cached separately as source_string:gates
+    encoding - None for the raw payload or one of payload.encodings, e.g., "gzip".
+               Compressed variants are built once from the raw payload and cached
+               separately as source_string|encoding
+    count - counts the lookup as a hit or a miss of payload_cache, False for the
+            lookup of the raw payload behind a compressed one, so that a request
+            is one hit or one miss
 """
 
 
-def load_display_data_by_source_string(source_string):
+def _payload_key(source_string, gates=default_gates, encoding=None):
+    key = source_string if gates == default_gates else f"{source_string}:{gates}"
+    return f"{key}|{encoding}" if encoding else key
+
+
+def load_display_data_by_source_string(source_string, gates=default_gates, encoding=None, count=True):
+    key = _payload_key(source_string, gates, encoding)
+    payload = payload_cache.get(key, count=count)
+    if payload is not None:
+        return payload
+    payload = sidecar.read(source_string, encoding=encoding) if gates == default_gates else None
+    if payload is None:
+        if encoding:
+            payload = load_display_data_by_source_string(source_string, gates=gates, count=False)
+            payload = compress(payload, encoding) if payload is not None else None
+        else:
+            payload = _load_display_data(source_string, gates=gates)
+    if payload is not None:
+        payload_cache.put(key, payload)
+    return payload
+
+
+def _load_display_data(source_string, gates=default_gates):
     if settings.SIMULATE:
         sweep = Sweep.dummy_data(source_string, u8=True)
     else:
@@ -294,74 +426,182 @@ def load_display_data_by_source_string(source_string):
     if sweep is None or not sweep["u8"]:
         return None
     symbol = list(sweep["u8"].keys())[0]
-    # Down-sample the sweep if the gate spacing is too fine (to save internet bandwidth)
-    elevations = sweep["elevations"]
-    azimuths = sweep["azimuths"]
-    values = sweep["u8"][symbol]
-    gatewidth = 1.0e-3 * sweep["gatewidth"]
-    # Only show up to gate 400 for bistatic data
-    if sweep["txrx"] == "B":
-        values = values[:, :400]
-    elif values.shape[1] > 1000:
-        stride = values.shape[1] // 1000
-        gatewidth *= float(stride)
-        values = values[:, ::stride]
-    if sweep.get("comment", None):
-        info = json.dumps({"comment": sweep["comment"]}, separators=(",", ":"))
-    else:
-        info = json.dumps(
-            {"wf": sweep["waveform"], "prf": round(sweep["prf"])},
-            separators=(",", ":"),
-        )
-    # Final assembly of the payload
-    ei16 = np.array(elevations / 180.0 * 32768.0, dtype=np.int16)
-    au16 = np.array(azimuths / 360.0 * 65536.0, dtype=np.uint16)
-    attr = 1 if sweep["txrx"] == "B" else 0
-    head = struct.pack(
-        "<hhhhddddffffffff",
-        *values.shape,
-        len(info),
-        attr,
-        sweep["time"],
-        sweep["latitude"],
-        sweep["longitude"],
-        0.0,
-        sweep["rxOffsetX"] if attr else 0.1,
-        sweep["rxOffsetY"] if attr else 0.2,
-        sweep["rxOffsetZ"] if attr else 0.3,
-        0.4,
-        sweep["sweepElevation"],
-        sweep["sweepAzimuth"],
-        0.0,
-        gatewidth,
-    )
-    payload = bytes(head) + bytes(info, "utf-8") + bytes(ei16) + bytes(au16) + bytes(values)
+    payload = pack(sweep, sweep["u8"][symbol], symbol, gates)
     # logger.debug(f"Payload size = {len(payload):,d} B")
     return payload
 
 
+def _load_validators(source_string, gates, encoding=None):
+    # The Sweep row and the modification time of its archive, looked up once and kept in payload_cache
+    # next to the payloads, so a cache hit stays free and cache.invalidate() of a re-ingested sweep
+    # drops them together. Each encoding is a different representation, so it gets its own ETag
+    if settings.SIMULATE:
+        return None, None
+    key = f"{source_string}#validators"
+    validators = payload_cache.get(key, count=False)
+    if validators is None:
+        parts = radar.re_4parts.search(source_string)
+        if parts is None:
+            return None, None
+        parts = parts.groupdict()
+        stamp = datetime.datetime.strptime(parts["time"], r"%Y%m%d-%H%M%S").replace(tzinfo=datetime.timezone.utc)
+        row = Sweep.objects.filter(time=stamp, name=parts["name"]).values_list("id", "path").first()
+        if row is None:
+            return None, None
+        try:
+            last_modified = int(os.path.getmtime(row[1]))
+        except OSError:
+            last_modified = None
+        validators = json.dumps([*row, last_modified]).encode("utf-8")
+        payload_cache.put(key, validators)
+    *row, last_modified = json.loads(validators)
+    return make_etag("load", _payload_key(source_string, gates, encoding), *row, last_modified), last_modified
+
+
 """
     Load a sweep - returns a dictionary
 
     pathway - the radar pathway, e.g., px1000, raxpol, etc.
     locator - the locator of the sweep, e.g., 20230616-020024-E2.6-Z
+
+    Optional query:
+    gates - maximum number of gates, e.g., ?gates=500, 0 = full resolution
+
+    The payload is sent pre-compressed according to Accept-Encoding (with
+    Content-Encoding set), so nginx passes it through without compressing it again
 """
 
 
 def load(request, pathway, locator):
+    if hasattr(request, "GET"):
+        gates = lod(request.GET.get("gates", default_gates))
+        encoding = negotiate(request.headers.get("Accept-Encoding", ""))
+    else:
+        gates = default_gates
+        encoding = None
     if settings.VERBOSE > 1:
         myname = colorize("archive.load()", "green")
-        logger.debug(f"{myname}   {colored_variables(pathway, locator)}")
+        logger.debug(f"{myname}   {colored_variables(pathway, locator, gates, encoding)}")
     if is_dirty_request(request):
         return not_allowed_request
     if pathway == "undefined" or pathway not in settings.RADARS:
         return invalid_query
     prefix = settings.RADARS[pathway]["prefix"]
-    payload = load_display_data_by_source_string(f"{prefix}-{locator}")
+    etag, last_modified = _load_validators(f"{prefix}-{locator}", gates, encoding)
+    if etag:
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+    payload = load_display_data_by_source_string(f"{prefix}-{locator}", gates=gates, encoding=encoding)
     if payload is None:
         return HttpResponse(f"{prefix}-{locator} not found. {nice_reply}", status=205)
     response = HttpResponse(payload, content_type="application/octet-stream")
     response["Cache-Control"] = "max-age=604800"
+    response["Vary"] = "Accept-Encoding"
+    if encoding:
+        response["Content-Encoding"] = encoding
+    if etag:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+# region Batch
+
+"""
+    Load many sweeps - streams a container of payloads
+
+    pathway - the radar pathway, e.g., px1000, raxpol, etc.
+
+    Query (either one):
+    locators - comma separated locators, e.g., ?locators=20230616-020024-E2.6-Z,20230616-020524-E2.6-Z
+    start, end, scan, symbol - a time window, e.g., ?start=20230616-020000&end=20230616-030000&scan=E2.6&symbol=Z
+
+    Optional query:
+    gates - maximum number of gates, see load()
+
+    The container is a sequence of records, one for each sweep, in the order of the sources, which
+    are decoded concurrently on load_many_pool and sent as soon as the next one in line is ready:
+    - length of the source string (uint16), source string, e.g., PX-20230616-020024-E2.6-Z
+    - length of the payload (uint32), payload in the format of load(), 0 = not found
+"""
+
+load_many_limit = 120
+load_many_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="load-many")
+
+
+def _load_many_sources(prefix, query):
+    if "locators" in query:
+        locators = [x for x in query["locators"].split(",") if x]
+        return [f"{prefix}-{x}" for x in locators]
+    start, end = query.get("start", ""), query.get("end", "")
+    scan, symbol = query.get("scan", "E4.0"), query.get("symbol", "Z")
+    if not is_valid_time(start) or not is_valid_time(end):
+        return []
+    # YYYYMMDD, YYYYMMDD-HHMM or YYYYMMDD-HHMMSS
+    start, end = [f"{x}-" if len(x) == 8 else x for x in (start, end)]
+    ss = datetime.datetime.strptime(start.ljust(15, "0"), r"%Y%m%d-%H%M%S").replace(tzinfo=datetime.timezone.utc)
+    ee = datetime.datetime.strptime(end.ljust(15, "0"), r"%Y%m%d-%H%M%S").replace(tzinfo=datetime.timezone.utc)
+    sweeps = Sweep.objects.filter(time__range=[ss, ee], name=prefix, scan=scan).order_by("time")
+    stamps = sweeps.values_list("time", flat=True)[: load_many_limit + 1]
+    return [f"{prefix}-{x.strftime(r'%Y%m%d-%H%M%S')}-{scan}-{symbol}" for x in stamps]
+
+
+def _load_many_record(source_string, payload):
+    name = source_string.encode("utf-8")
+    payload = payload or b""
+    return struct.pack("<H", len(name)) + name + struct.pack("<I", len(payload)) + payload
+
+
+def _load_many_payload(source_string, gates):
+    close_old_connections()
+    try:
+        return load_display_data_by_source_string(source_string, gates)
+    finally:
+        close_old_connections()
+
+
+async def _load_many_stream(sources, gates):
+    myname = colorize("archive.load_many()", "green")
+    tic = time.time()
+    futures = [load_many_pool.submit(_load_many_payload, x, gates) for x in sources]
+    try:
+        for source_string, future in zip(sources, futures):
+            try:
+                payload = await asyncio.wrap_future(future)
+            except Exception as e:
+                logger.warning(f"{myname} {source_string} {e}")
+                payload = None
+            yield _load_many_record(source_string, payload)
+    finally:
+        # No-op when all are sent, drops the sweeps not yet started if the client went away
+        for future in futures:
+            future.cancel()
+    if settings.VERBOSE > 1:
+        count = len(sources)
+        elapsed = time.time() - tic
+        logger.debug(f"{myname}   {colored_variables(count, gates)}   {elapsed:.3f} s")
+
+
+async def load_many(request, pathway):
+    if is_dirty_request(request):
+        return not_allowed_request
+    if pathway == "undefined" or pathway not in settings.RADARS:
+        return invalid_query
+    prefix = settings.RADARS[pathway]["prefix"]
+    query = request.GET
+    gates = lod(query.get("gates", default_gates))
+    loop = asyncio.get_running_loop()
+    sources = await loop.run_in_executor(archive_pool, functools.partial(_run_view, _load_many_sources, prefix, query))
+    if not sources:
+        return invalid_query
+    if len(sources) > load_many_limit:
+        return HttpResponse(f"Too many sweeps (limit = {load_many_limit})\n", status=413)
+    if settings.VERBOSE > 1:
+        myname = colorize("archive.load_many()", "green")
+        count = len(sources)
+        logger.debug(f"{myname}   {colored_variables(pathway, count, gates)}")
+    response = StreamingHttpResponse(_load_many_stream(sources, gates), content_type="application/octet-stream")
+    response["Cache-Control"] = "no-cache"
     return response
 
 
@@ -444,25 +684,23 @@ def _years(prefix):
 
 
 """
+    Catchup - returns everything the archive page needs to show the latest data
+
     pathway - Input pathway name, e.g., px1000, raxpol, etc.
     scan - The 4-th component of filename describing the scan, e.g., E4.0, A120.0, etc.
     symbol - The symbol of a product, e.g., Z, V, W, etc.
+
+    The snapshot is built by backhaul.monitor with catchup_snapshot() whenever new
+    sweeps land and sent to every process through the cache-relay channel (also kept
+    in Redis for processes that just started). It is only computed here when there is
+    no recent snapshot
 """
 
 
-@never_cache
-def catchup(request, pathway, scan="E4.0", symbol="Z"):
-    if settings.VERBOSE > 1:
-        myname = colorize("archive.catchup()", "green")
-        logger.debug(f"{myname}   {colored_variables(pathway, scan, symbol)}")
-    if is_dirty_request(request):
-        return not_allowed_request
-    if pathway == "undefined" or pathway not in settings.RADARS:
-        return invalid_query
-    prefix = settings.RADARS[pathway]["prefix"]
+def _catchup(prefix, scan="E4.0", symbol="Z"):
     ymd, hour = latest(prefix)
     if ymd is None:
-        data = {
+        return {
             "dateTimeString": "19700101-0000",
             "dayISOString": "1970/01/01Z",
             "daysActive": {},
@@ -473,18 +711,86 @@ def catchup(request, pathway, scan="E4.0", symbol="Z"):
             "items": [],
             "latestScan": "",
         }
-    else:
-        date_time_string = f"{ymd}-{hour:02d}00"
-        add = _table_block(prefix, f"{date_time_string}-{symbol}")
-        data = {
-            "dateTimeString": date_time_string,
-            "dayISOString": f"{ymd[0:4]}/{ymd[4:6]}/{ymd[6:8]}Z",
-            "daysActive": _month(prefix, ymd),
-            "yearsActive": _years(prefix),
-            "hoursActive": _count(prefix, ymd),
-            "hour": hour,
-            "latestScan": _latest_scan(prefix, scan),
-        }
-        data = {**data, **add}
-    payload = json.dumps(data, separators=(",", ":"))
+    date_time_string = f"{ymd}-{hour:02d}00"
+    add = _table_block(prefix, f"{date_time_string}-{symbol}")
+    data = {
+        "dateTimeString": date_time_string,
+        "dayISOString": f"{ymd[0:4]}/{ymd[4:6]}/{ymd[6:8]}Z",
+        "daysActive": _month(prefix, ymd),
+        "yearsActive": _years(prefix),
+        "hoursActive": _count(prefix, ymd),
+        "hour": hour,
+        "latestScan": _latest_scan(prefix, scan),
+    }
+    return {**data, **add}
+
+
+def catchup_snapshot(pathway):
+    prefix = settings.RADARS[pathway]["prefix"]
+    return json.dumps(_catchup(prefix), separators=(",", ":"))
+
+
+def _recent_catchup_snapshot(pathway):
+    stamp, payload = catchup_snapshots.get(pathway, (0, None))
+    if payload is not None and time.time() - stamp < catchup_max_age:
+        return payload
+    payload = read_catchup(pathway)
+    if payload is not None:
+        catchup_snapshots[pathway] = (time.time(), payload)
+    return payload
+
+
+@never_cache
+def catchup(request, pathway, scan="E4.0", symbol="Z"):
+    if settings.VERBOSE > 1:
+        myname = colorize("archive.catchup()", "green")
+        logger.debug(f"{myname}   {colored_variables(pathway, scan, symbol)}")
+    if is_dirty_request(request):
+        return not_allowed_request
+    if pathway == "undefined" or pathway not in settings.RADARS:
+        return invalid_query
+    payload = None
+    if scan == "E4.0" and symbol == "Z":
+        payload = _recent_catchup_snapshot(pathway)
+    if payload is None:
+        prefix = settings.RADARS[pathway]["prefix"]
+        payload = json.dumps(_catchup(prefix, scan, symbol), separators=(",", ":"))
     return HttpResponse(payload, content_type="application/json")
+
+
+# region Async
+
+"""
+    Async versions of the archive views
+
+    Sync views under daphne all run on the one thread of sync_to_async(thread_sensitive=True),
+    so a slow decode holds up every other request. These run the same views on a bounded pool
+    of settings.ARCHIVE_WORKERS threads instead, keeping the event loop free and letting
+    independent requests proceed concurrently. Each thread manages its own database connection
+"""
+
+archive_pool = concurrent.futures.ThreadPoolExecutor(max_workers=settings.ARCHIVE_WORKERS, thread_name_prefix="archive")
+
+
+def _run_view(view, request, *args, **kwargs):
+    close_old_connections()
+    try:
+        return view(request, *args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def _offload(view):
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(archive_pool, functools.partial(_run_view, view, request, *args, **kwargs))
+
+    return wrapper
+
+
+amonth = _offload(month)
+acount = _offload(count)
+atable = _offload(table)
+aload = _offload(load)
+acatchup = _offload(catchup)
@@ -0,0 +1,347 @@
+# frontend/cache.py
+#
+#   RadarHub
+#   Cache of the rendered payloads for /data/load
+#
+#   A rendered payload of an archived sweep, e.g., PX-20130520-191000-E2.6-Z,
+#   never changes once it is produced, so the final bytes can be kept and served
+#   again without going through Sweep.read() -> Sweep.load() -> val2ind()
+#
+#   PayloadCache - private to the process
+#   RedisPayloadCache - shared by all daphne processes on the host
+#
+#   Entries of a sweep are invalidated across all processes by publishing the
+#   sweep, e.g., PX-20130520-191000-E2.6-, on the "cache-relay" channel, which
+#   every frontend.relay.Relay listens to. The same channel also carries the
+#   invalidation of the month summaries of /data/month, e.g., PX-202405, and
+#   the catchup snapshots of /data/catchup built by backhaul.monitor
+#
+#   Created by Boonleng Cheong
+#
+
+import json
+import time
+import redis
+import logging
+import threading
+
+from collections import OrderedDict
+
+from common import colorize, colored_variables, pretty_object_name
+
+logger = logging.getLogger("frontend")
+
+channel = "cache-relay"
+
+
+class PayloadCache:
+    """
+    An in-memory LRU cache of payloads (bytes) with a memory budget
+
+    - `budget` : maximum total size of the payloads (B)
+    - `name` : name for logging
+
+    Methods:
+    - `get(key, count=True)` : returns the payload or None, counted as a hit or a miss unless `count` is False
+    - `put(key, payload)` : stores a payload, evicting the least recently used ones to fit the budget
+    - `invalidate(prefix)` : removes all entries with keys that start with `prefix`
+    - `clear()` : removes all entries
+    - `stats()` : returns a dictionary of the counters
+    """
+
+    def __init__(self, budget=256 * 1024 * 1024, name="memory"):
+        self.name = pretty_object_name("PayloadCache", name)
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __repr__(self):
+        return f"{self.name} {len(self.entries)} items   {self.size:,d} / {self.budget:,d} B"
+
+    def get(self, key, count=True):
+        with self.lock:
+            payload = self.entries.get(key, None)
+            if payload is None:
+                self.misses += count
+                return None
+            self.entries.move_to_end(key)
+            self.hits += count
+            return payload
+
+    def put(self, key, payload):
+        size = len(payload)
+        if size > self.budget:
+            logger.debug(f"{self.name} {key} too large   {colored_variables(size)}")
+            return False
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = payload
+            self.size += size
+            while self.size > self.budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, prefix):
+        with self.lock:
+            keys = [key for key in self.entries if key.startswith(prefix)]
+            for key in keys:
+                self.size -= len(self.entries.pop(key))
+        if keys:
+            logger.debug(f"{self.name} {colorize(prefix, 'yellow')} {len(keys)} removed")
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "count": len(self.entries),
+                "size": self.size,
+                "budget": self.budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+class RedisPayloadCache:
+    """
+    A Redis backed LRU cache of payloads (bytes) with a memory budget, shared by all processes
+
+    - `budget` : maximum total size of the payloads (B)
+    - `namespace` : prefix of all the Redis keys
+    - `host` : Redis host
+    - `port` : Redis port
+
+    The bookkeeping is kept in Redis along with the payloads:
+    - `{namespace}:lru` : sorted set of keys, scored by the last access time
+    - `{namespace}:size` : hash of the payload sizes
+    - `{namespace}:total` : total size of the payloads
+    - `{namespace}:hits`, `{namespace}:misses`, `{namespace}:evictions` : counters
+
+    Methods are the same as PayloadCache
+    """
+
+    # KEYS = [lru, size, total, evictions]   ARGV = [key, payload, now, budget, namespace]
+    _put_script = """
+        local old = redis.call('HGET', KEYS[2], ARGV[1])
+        if old then redis.call('DECRBY', KEYS[3], old) end
+        local size = string.len(ARGV[2])
+        redis.call('SET', ARGV[5] .. ':' .. ARGV[1], ARGV[2])
+        redis.call('HSET', KEYS[2], ARGV[1], size)
+        redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+        local total = redis.call('INCRBY', KEYS[3], size)
+        local evicted = 0
+        while total > tonumber(ARGV[4]) do
+            local oldest = redis.call('ZRANGE', KEYS[1], 0, 0)
+            if #oldest == 0 then break end
+            local s = redis.call('HGET', KEYS[2], oldest[1]) or 0
+            redis.call('DEL', ARGV[5] .. ':' .. oldest[1])
+            redis.call('ZREM', KEYS[1], oldest[1])
+            redis.call('HDEL', KEYS[2], oldest[1])
+            total = redis.call('DECRBY', KEYS[3], s)
+            evicted = evicted + 1
+        end
+        if evicted > 0 then redis.call('INCRBY', KEYS[4], evicted) end
+        return evicted
+    """
+
+    # KEYS = [lru, size, total]   ARGV = [namespace, key, key, ...]
+    _remove_script = """
+        local count = 0
+        for i = 2, #ARGV do
+            local s = redis.call('HGET', KEYS[2], ARGV[i])
+            if s then
+                redis.call('DEL', ARGV[1] .. ':' .. ARGV[i])
+                redis.call('ZREM', KEYS[1], ARGV[i])
+                redis.call('HDEL', KEYS[2], ARGV[i])
+                redis.call('DECRBY', KEYS[3], s)
+                count = count + 1
+            end
+        end
+        return count
+    """
+
+    def __init__(self, budget=256 * 1024 * 1024, namespace="radarhub:payload", host="localhost", port=6379):
+        self.name = pretty_object_name("RedisPayloadCache", namespace)
+        self.budget = budget
+        self.namespace = namespace
+        self.redis = redis.StrictRedis(host=host, port=port)
+        self.lru = f"{namespace}:lru"
+        self.sizes = f"{namespace}:size"
+        self.total = f"{namespace}:total"
+        self.counters = [f"{namespace}:hits", f"{namespace}:misses", f"{namespace}:evictions"]
+        self.put_script = self.redis.register_script(self._put_script)
+        self.remove_script = self.redis.register_script(self._remove_script)
+
+    def __len__(self):
+        return self.redis.zcard(self.lru)
+
+    def __contains__(self, key):
+        return self.redis.hexists(self.sizes, key)
+
+    def __repr__(self):
+        size = int(self.redis.get(self.total) or 0)
+        return f"{self.name} {len(self)} items   {size:,d} / {self.budget:,d} B"
+
+    def get(self, key, count=True):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(f"{self.namespace}:{key}")
+            pipe.zadd(self.lru, {key: time.time()}, xx=True)
+            payload, _ = pipe.execute()
+            if count:
+                self.redis.incr(self.counters[0] if payload is not None else self.counters[1])
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"{self.name} {e}")
+            return None
+        return payload
+
+    def put(self, key, payload):
+        size = len(payload)
+        if size > self.budget:
+            logger.debug(f"{self.name} {key} too large   {colored_variables(size)}")
+            return False
+        try:
+            keys = [self.lru, self.sizes, self.total, self.counters[2]]
+            self.put_script(keys=keys, args=[key, payload, time.time(), self.budget, self.namespace])
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"{self.name} {e}")
+            return False
+        return True
+
+    def invalidate(self, prefix):
+        try:
+            keys = [k for k, _ in self.redis.hscan_iter(self.sizes, match=f"{prefix}*")]
+            if not keys:
+                return 0
+            count = self.remove_script(keys=[self.lru, self.sizes, self.total], args=[self.namespace, *keys])
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"{self.name} {e}")
+            return 0
+        logger.debug(f"{self.name} {colorize(prefix, 'yellow')} {count} removed")
+        return count
+
+    def clear(self):
+        keys = [k.decode() for k in self.redis.hkeys(self.sizes)]
+        if keys:
+            self.remove_script(keys=[self.lru, self.sizes, self.total], args=[self.namespace, *keys])
+
+    def stats(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zcard(self.lru)
+        pipe.get(self.total)
+        for counter in self.counters:
+            pipe.get(counter)
+        count, size, hits, misses, evictions = [int(x or 0) for x in pipe.execute()]
+        total = hits + misses
+        return {
+            "backend": "redis",
+            "count": count,
+            "size": size,
+            "budget": self.budget,
+            "hits": hits,
+            "misses": misses,
+            "evictions": evictions,
+            "ratio": round(hits / total, 4) if total else 0.0,
+        }
+
+
+def make_payload_cache(config):
+    """
+    Returns a payload cache from a configuration, e.g., settings.PAYLOAD_CACHE
+
+    - `config` : a dictionary of {"backend": "memory" or "redis", "budget": _BYTES_}
+    """
+    backend = config.get("backend", "memory")
+    budget = config.get("budget", 256 * 1024 * 1024)
+    if backend == "redis":
+        return RedisPayloadCache(budget=budget)
+    return PayloadCache(budget=budget)
+
+
+def invalidate(prefix):
+    """
+    Invalidates cached payloads of all processes, e.g., when a sweep is re-ingested
+
+    - `prefix` : common prefix of the keys, e.g., PX-20130520-191000-E2.6-
+    """
+    myname = colorize("cache.invalidate()", "green")
+    try:
+        redis.StrictRedis().publish(channel, json.dumps({"invalidate": prefix}).encode("utf-8"))
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"{myname} {e}")
+        return
+    logger.debug(f"{myname}   {colored_variables(prefix)}")
+
+
+def invalidate_month(name, date):
+    """
+    Invalidates cached month summaries of all processes, e.g., when build_day() writes a Day entry
+
+    - `name` : prefix of the radar, e.g., PX
+    - `date` : a date of the month, datetime.date or datetime.datetime
+    """
+    myname = colorize("cache.invalidate_month()", "green")
+    key = f"{name}-{date.strftime(r'%Y%m')}"
+    try:
+        redis.StrictRedis().publish(channel, json.dumps({"month": key}).encode("utf-8"))
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"{myname} {e}")
+        return
+    logger.debug(f"{myname}   {colored_variables(key)}")
+
+
+catchup_key = "radarhub:catchup"
+catchup_max_age = 3600
+
+
+def publish_catchup(pathway, payload):
+    """
+    Stores the catchup snapshot (JSON string) of a pathway in Redis and sends it to all processes
+
+    - `pathway` : the radar pathway, e.g., px1000
+    - `payload` : the JSON string of /data/catchup
+    """
+    myname = colorize("cache.publish_catchup()", "green")
+    try:
+        relay = redis.StrictRedis()
+        relay.set(f"{catchup_key}:{pathway}", payload, ex=catchup_max_age)
+        relay.publish(channel, json.dumps({"catchup": pathway, "payload": payload}).encode("utf-8"))
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"{myname} {e}")
+        return
+    size = len(payload)
+    logger.debug(f"{myname}   {colored_variables(pathway, size)}")
+
+
+def read_catchup(pathway):
+    """
+    Returns the catchup snapshot (JSON string) of a pathway from Redis or None
+
+    - `pathway` : the radar pathway, e.g., px1000
+    """
+    try:
+        payload = redis.StrictRedis().get(f"{catchup_key}:{pathway}")
+    except redis.exceptions.RedisError:
+        return None
+    return payload.decode("utf-8") if payload else None
@@ -17,17 +17,21 @@
 #   - locator: a string that contains the datetime and scan (2 parts), e.g., 20130520-191000-E2.6
 
 import re
+import json
 import radar
+import struct
 import pprint
 import logging
 import datetime
 import threading
+import collections
 import numpy as np
 
 from django.conf import settings
-from django.core.validators import int_list_validator
 from django.utils.translation import gettext_lazy
 from django.db import models
+from django.db.models.functions import ExtractHour
+from django.db.models.query_utils import DeferredAttribute
 
 from common import colorize, colored_variables, pretty_object_name, get_user_agent_string
 
@@ -70,7 +74,20 @@ datashop = None
 # Some helper functions
 
 
-def val2ind(v, symbol="Z"):
+# Affine steps to map values to indices, applied in place, e.g., Z: (v * 2.0) + 64.0
+val2ind_steps = {
+    "Z": ((np.multiply, 2.0), (np.add, 64.0)),
+    "V": ((np.multiply, 2.0), (np.add, 128.0)),
+    "W": ((np.multiply, 20.0),),
+    "D": ((np.multiply, 10.0), (np.add, 100.0)),
+    "P": ((np.multiply, 128.0), (np.divide, 180.0), (np.add, 128.0)),
+    "I": ((np.subtract, 0.5), (np.multiply, 42.0), (np.add, 46.0)),
+}
+# Piecewise segments of R: x * 52.8751, then x * 300.0 - 173.0 for x > 0.7, then x * 1000.0 - 824.0 for x > 0.93
+rho2ind_segments = ((0.7, 300.0, -173.0), (0.93, 1000.0, -824.0))
+
+
+def val2ind(v, symbol="Z", out=None, work=None):
     """
     val2ind - Convert a value to an index
 
@@ -84,43 +101,210 @@ def val2ind(v, symbol="Z"):
 
     - v: value to be converted
     - symbol: symbol to be used for the conversion
+    - out: optional preallocated uint8 array of the same shape as v for the output
+    - work: optional preallocated float array of the same shape as v for the intermediate values
 
-    Returns an integer index
+    All steps are carried out in place on `work` so there are no temporary arrays when
+    `work` is supplied (R needs one more for its piecewise segments). Returns an integer
+    index array
     """
-
-    def rho2ind(x):
-        m3 = x > 0.93
-        m2 = np.logical_and(x > 0.7, ~m3)
-        index = x * 52.8751
-        index[m2] = x[m2] * 300.0 - 173.0
-        index[m3] = x[m3] * 1000.0 - 824.0
-        return index
-
-    if symbol == "Z":
-        u8 = v * 2.0 + 64.0
-    elif symbol == "V":
-        u8 = v * 2.0 + 128.0
-    elif symbol == "W":
-        u8 = v * 20.0
-    elif symbol == "D":
-        u8 = v * 10.0 + 100.0
-    elif symbol == "P":
-        u8 = v * 128.0 / 180.0 + 128.0
-    elif symbol == "R":
-        u8 = rho2ind(v)
-    elif symbol == "I":
-        u8 = (v - 0.5) * 42 + 46
+    if out is None:
+        out = np.empty(v.shape, dtype=np.uint8)
+    if work is None:
+        work = np.empty(v.shape, dtype=v.dtype if v.dtype.kind == "f" else np.float32)
+
+    if symbol == "R":
+        # The output array doubles as the mask since it is only filled at the end
+        mask = out.view(bool)
+        temp = np.empty_like(work)
+        np.multiply(v, 52.8751, out=work)
+        for x, a, b in rho2ind_segments:
+            np.multiply(v, a, out=temp)
+            np.add(temp, b, out=temp)
+            np.greater(v, x, out=mask)
+            np.copyto(work, temp, where=mask)
+    elif symbol in val2ind_steps:
+        source = v
+        for ufunc, value in val2ind_steps[symbol]:
+            ufunc(source, value, out=work)
+            source = work
     else:
-        u8 = v
+        np.copyto(work, v, casting="unsafe")
     # Map to closest integer, 0 is transparent, 1+ is finite.
-    # np.nan will be converted to 0 during np.nan_to_num(...)
-    return np.nan_to_num(np.clip(np.round(u8), 1.0, 255.0), copy=False).astype(np.uint8)
+    # np.nan passes through np.clip(...) and is converted to 0 by np.fmax(...)
+    np.rint(work, out=work)
+    np.clip(work, 1.0, 255.0, out=work)
+    np.fmax(work, 0.0, out=work)
+    np.copyto(out, work, casting="unsafe")
+    return out
 
 
 def starts_with_cf(string):
     return bool(re.match(r"^cf", string, re.IGNORECASE))
 
 
+class HourlyCountDescriptor(DeferredAttribute):
+    """
+    Keeps the hourly counts as a tuple of 24 ints and the hours with data derived from it
+
+    The value is immutable, so the derived `_active_hours` cannot go out of sync. Assign
+    a new value to change the counts, e.g., day.hourly_count = counts
+    """
+
+    def __set__(self, instance, value):
+        value = self.field.to_python(value)
+        instance.__dict__[self.field.attname] = value
+        instance.__dict__["_active_hours"] = tuple(k for k, n in enumerate(value) if n)
+
+
+class HourlyCountField(models.BinaryField):
+    """
+    Number of sweeps of each hour, packed as 24 little-endian uint32 (96 B)
+
+    In Python, the value is a tuple of 24 ints. A comma-separated string, e.g., "0,0,...,3",
+    is also accepted, which is also how the rows from the CharField days (cast to bytes
+    by the migration) are read until they are repacked (dbtool.py --repack-days)
+    """
+
+    descriptor_class = HourlyCountDescriptor
+    count = 24
+    format = "<24I"
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("default", (0,) * 24)
+        super().__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        if value is None:
+            return (0,) * self.count
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value)
+            # A packed array always has NUL bytes (counts < 2^24), a legacy CSV never does
+            if b"\x00" in value:
+                return struct.unpack(self.format, value)
+            value = value.decode("ascii")
+        if isinstance(value, str):
+            value = value.split(",") if value else []
+        value = tuple(int(n) for n in value)
+        if len(value) != self.count:
+            raise ValueError(f"HourlyCountField expects {self.count} values, got {len(value)}")
+        return value
+
+    def from_db_value(self, value, expression, connection):
+        return self.to_python(value)
+
+    def get_prep_value(self, value):
+        return struct.pack(self.format, *self.to_python(value))
+
+    def value_to_string(self, obj):
+        return ",".join(str(n) for n in self.value_from_object(obj))
+
+
+class Members(dict):
+    """
+    Archive members of a sweep, {symbol: [name, size, offset, offset_data], ...}, as used by
+    radar.read(), together with the `stem` of the sweep, e.g., PX-20130520-191000-E2.6
+    """
+
+    def __init__(self, value=(), stem=None):
+        super().__init__(value)
+        self.stem = stem
+
+    def member_name(self, symbol):
+        return f"{self.stem}.nc" if symbol == "*" else f"{self.stem}-{symbol}.nc"
+
+
+class TarinfoDescriptor(DeferredAttribute):
+    """
+    Fills in the member names that TarinfoField leaves out, derived from the name, time and scan
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        time = instance.__dict__.get("time")
+        stem = (
+            f"{instance.name}-{time.strftime(r'%Y%m%d-%H%M%S')}-{instance.scan}" if hasattr(time, "strftime") else None
+        )
+        if not isinstance(value, Members) or value.stem != stem:
+            value = Members(value, stem)
+            if stem:
+                for symbol, info in value.items():
+                    if not info[0]:
+                        value[symbol] = [value.member_name(symbol), *info[1:]]
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class TarinfoField(models.BinaryField):
+    """
+    Archive members of a sweep, packed as a version byte followed by, for each member,
+    symbol (uint8 length + ASCII), size, offset, offset_data (3 x uint32) and name (uint8
+    length + UTF-8). The name is left empty when it is the one derived from the sweep,
+    so a typical six-member row is 91 B instead of ~400 B of JSON
+
+    In Python, the value is a dictionary like radar.read_tarinfo(). Rows of the JSONField
+    are read as JSON until they are repacked (dbtool.py --repack-sweeps)
+    """
+
+    descriptor_class = TarinfoDescriptor
+    version = 1
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("default", dict)
+        super().__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        if value is None:
+            return {}
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value)
+            if value[:1] != bytes([self.version]):
+                value = value.decode("utf-8")
+            else:
+                return self.unpack(value)
+        if isinstance(value, str):
+            value = json.loads(value) if value else {}
+        return {k: list(v) for k, v in value.items()}
+
+    def unpack(self, value):
+        members = {}
+        k = 1
+        while k < len(value):
+            n = value[k]
+            symbol = value[k + 1 : k + 1 + n].decode("ascii")
+            k += 1 + n
+            size, offset, offset_data, n = struct.unpack_from("<IIIB", value, k)
+            k += 13
+            members[symbol] = [value[k : k + n].decode("utf-8"), size, offset, offset_data]
+            k += n
+        return members
+
+    def from_db_value(self, value, expression, connection):
+        return self.to_python(value)
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        stem = getattr(value, "stem", None)
+        value = value if isinstance(value, Members) else self.to_python(value)
+        packed = bytearray([self.version])
+        for symbol, (name, size, offset, offset_data) in value.items():
+            if stem and name == value.member_name(symbol):
+                name = ""
+            symbol, name = symbol.encode("ascii"), name.encode("utf-8")
+            packed += struct.pack("<B", len(symbol)) + symbol
+            packed += struct.pack("<IIIB", size, offset, offset_data, len(name)) + name
+        return bytes(packed)
+
+    def value_to_string(self, obj):
+        return json.dumps(self.value_from_object(obj))
+
+
 # Create your models here.
 
 
@@ -136,10 +320,11 @@ class Day(models.Model):
     - `green` : green count
     - `orange` : orange count
     - `red` : red count
-    - `hourly_count` : number of sweeps of each hour
+    - `hourly_count` : number of sweeps of each hour, a tuple of 24 ints (see HourlyCountField)
 
     Properties:
     - `day_string` : returns a day string in YYYY-MM-DD format
+    - `active_hours` : returns the hours with data (tuple of int)
     - `first_hour` : returns the first hour with data (int)
     - `last_hour` : returns the last hour with data (int)
     - `day_range` : returns the day as a range, e.g., ['2022-01-21 00:00:00Z', '2022-01-21 23:59:59.9Z]
@@ -159,12 +344,10 @@ class Day(models.Model):
     green = models.PositiveIntegerField(default=0)
     orange = models.PositiveIntegerField(default=0)
     red = models.PositiveIntegerField(default=0)
-    hourly_count = models.CharField(
-        default="0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0", max_length=120, validators=[int_list_validator]
-    )
+    hourly_count = HourlyCountField()
 
     class Meta:
-        indexes = [models.Index(fields=["date"]), models.Index(fields=["name"])]
+        indexes = [models.Index(fields=["date"]), models.Index(fields=["name", "date"])]
 
     def __repr__(self):
         self.fix_date()
@@ -198,7 +381,7 @@ class Day(models.Model):
                 s = super_numbers[q] + str(r)
                 return f"{s:>4}"
 
-            counts = "".join([_int2str(int(n)) for n in self.hourly_count.split(",")])
+            counts = "".join([_int2str(n) for n in self.hourly_count])
             show = f"{self.name}-{date} {dot} {self._vbar()} {counts}"
         return show
 
@@ -222,15 +405,22 @@ class Day(models.Model):
         self.fix_date()
         return self.date.strftime(format)
 
+    @property
+    def active_hours(self):
+        if "_active_hours" not in self.__dict__:
+            # Deferred field, accessing it loads the value through HourlyCountDescriptor
+            self.hourly_count
+        return self.__dict__["_active_hours"]
+
     @property
     def first_hour(self):
-        hours = [k for k, e in enumerate(self.hourly_count.split(",")) if e != "0"]
-        return min(hours) if len(hours) else None
+        hours = self.active_hours
+        return hours[0] if hours else None
 
     @property
     def last_hour(self):
-        hours = [k for k, e in enumerate(self.hourly_count.split(",")) if e != "0"]
-        return max(hours) if len(hours) else None
+        hours = self.active_hours
+        return hours[-1] if hours else None
 
     @property
     def day_range(self):
@@ -270,54 +460,26 @@ class Day(models.Model):
         return cond
 
     def summarize(self):
-        myname = colorize("Day.compute()", "green")
+        myname = colorize("Day.summarize()", "green")
         logger.debug(f"{myname}")
 
-        day_datetime = datetime.datetime(self.date.year, self.date.month, self.date.day, tzinfo=datetime.timezone.utc)
-        hourly_count = [int(h) for h in self.hourly_count.split(",")]
-        stride = datetime.timedelta(minutes=20)
-        hour = datetime.timedelta(hours=1)
-
         day_set = Sweep.objects.filter(time__range=self.day_range, name=self.name)
-        if day_set.count() == 0:
+        rows = self._tallies(day_set)
+        # Hours of sweeps ingested before the gate counts were kept are tallied once, a few representatives each
+        hours = {k for k, count in enumerate(self.hourly_count) if count} - {row["hour"] for row in rows}
+        if hours:
+            self._tally(day_set, hours)
+            rows = self._tallies(day_set)
+        # E0.0 only counts in the hours without any other scan
+        scans = collections.defaultdict(set)
+        for row in rows:
+            scans[row["hour"]].add(row["scan"])
+        rows = [row for row in rows if row["scan"] != "E0.0" or scans[row["hour"]] == {"E0.0"}]
+        # One sweep's worth per (hour, scan), the mean of the counted sweeps, so that the hours
+        # counted at ingest and the hours of one representative from _tally() weigh the same
+        total, b, g, o, r = [sum((row[x] or 0) / row["n"] for row in rows) for x in ("t", "b", "g", "o", "r")]
+        if not total:
             return
-
-        b = 0
-        g = 0
-        o = 0
-        r = 0
-        total = 0
-        for k, count in enumerate(hourly_count):
-            if count == 0:
-                continue
-            logger.debug(f"{myname}   {colored_variables(k, count)}")
-            s = day_datetime + k * hour
-            e = s + hour
-            date_range = [s, e]
-            hour_set = day_set.filter(time__range=date_range, name=self.name)
-            scans = list(np.unique([sweep.scan for sweep in hour_set]))
-            if len(scans) > 1 and "E0.0" in scans:
-                scans.remove("E0.0")
-            for j, scan in enumerate(scans):
-                sweeps = hour_set.filter(time__range=date_range, name=self.name, scan=scan)
-                if sweeps.exists():
-                    select = j * len(sweeps) // len(scans)
-                    sweep = sweeps[select] if select < len(sweeps) else sweeps.first()
-                    logger.debug(f"DEBUG: {sweep}")
-                    sweep.load(finite=True, symbols=["Z"])
-                    z = sweep.z
-                    # Zero out the first few kilometers
-                    if sweep.kind == Sweep.Kind.WDS:
-                        ng = int(5000.0 / sweep.data["gatewidth"])
-                    else:
-                        ng = 24
-                    sweep.z[:, :ng] = -100.0
-                    b += np.sum(z >= 5.0)
-                    g += np.sum(z >= 20.0)
-                    o += np.sum(z >= 35.0)
-                    r += np.sum(z >= 50.0)
-                    total += z.size
-                s += stride
         # print(f'total = {total}  b = {b}  g = {g}  o = {o}  r = {r}')
         r = 1000 * r / o if r else 0
         o = 1000 * o / g if o else 0
@@ -330,6 +492,44 @@ class Day(models.Model):
         self.red = int(r)
         self.save()
 
+    @staticmethod
+    def _tallies(day_set):
+        # Gate counts of each hour and scan in one GROUP BY query
+        counted = day_set.filter(total__isnull=False).annotate(hour=ExtractHour("time"))
+        return list(
+            counted.values("hour", "scan")
+            .annotate(
+                n=models.Count("id"),
+                t=models.Sum("total"),
+                b=models.Sum("blue"),
+                g=models.Sum("green"),
+                o=models.Sum("orange"),
+                r=models.Sum("red"),
+            )
+            .order_by()
+        )
+
+    def _tally(self, day_set, hours):
+        myname = colorize("Day._tally()", "green")
+        day_datetime = datetime.datetime(self.date.year, self.date.month, self.date.day, tzinfo=datetime.timezone.utc)
+        hour = datetime.timedelta(hours=1)
+        for k in sorted(hours):
+            count = self.hourly_count[k]
+            logger.debug(f"{myname}   {colored_variables(k, count)}")
+            s = day_datetime + k * hour
+            hour_set = day_set.filter(time__range=[s, s + hour])
+            scans = list(np.unique([sweep.scan for sweep in hour_set]))
+            if len(scans) > 1 and "E0.0" in scans:
+                scans.remove("E0.0")
+            for j, scan in enumerate(scans):
+                sweeps = hour_set.filter(scan=scan)
+                if sweeps.exists():
+                    select = j * len(sweeps) // len(scans)
+                    sweep = sweeps[select] if select < len(sweeps) else sweeps.first()
+                    logger.debug(f"DEBUG: {sweep}")
+                    if sweep.tally():
+                        sweep.save(update_fields=Sweep.tally_fields)
+
 
 class Visitor(models.Model):
     """
@@ -396,6 +596,9 @@ class Sweep(models.Model):
                  {"Z": (name, size, offset, offset_data),
                   "V": (name, size, offset, offset_data),
                   "W": (name, size, offset, offset_data), ...}
+                 packed in binary, see TarinfoField
+    - `total` : number of reflectivity gates, counted at ingest
+    - `blue`, `green`, `orange`, `red` : number of gates at or above 5, 20, 35 and 50 dBZ
 
     Properties:
     - `z` : reflectivity
@@ -406,7 +609,9 @@ class Sweep(models.Model):
     - `r` : correlation coefficient
 
     Methods:
-    - `load(symbols=["Z", "V", "W", "D", "P", "R"], finite=False, verbose=0, suppress=False)` : loads the data
+    - `load(symbols=["Z", "V", "W", "D", "P", "R"], finite=False, verbose=0, suppress=False)` : loads the data,
+      only the archive members of `symbols` are extracted and decoded
+    - `tally(data=None)` : counts the reflectivity gates of `data` into `total`, `blue`, `green`, `orange` and `red`
     - `summary(markdown=False)` : prints a summary of the data
 
     Static Methods:
@@ -436,11 +641,23 @@ class Sweep(models.Model):
     name = models.CharField(max_length=16)
     path = models.CharField(max_length=256)
     symbols = models.CharField(max_length=256, blank=True)
-    tarinfo = models.JSONField(blank=True, default=dict)
+    tarinfo = TarinfoField(blank=True)
+    total = models.PositiveIntegerField(null=True, blank=True)
+    blue = models.PositiveIntegerField(null=True, blank=True)
+    green = models.PositiveIntegerField(null=True, blank=True)
+    orange = models.PositiveIntegerField(null=True, blank=True)
+    red = models.PositiveIntegerField(null=True, blank=True)
     data = None
 
+    tally_fields = ["total", "blue", "green", "orange", "red"]
+
     class Meta:
-        indexes = [models.Index(fields=["time"]), models.Index(fields=["name"])]
+        # Hot queries filter on name + time range (+ scan), see dbtool.py --explain
+        indexes = [
+            models.Index(fields=["time"]),
+            models.Index(fields=["name", "time"]),
+            models.Index(fields=["name", "time", "scan"]),
+        ]
 
     def __repr__(self, format=None):
         datetimeString = self.time.strftime(r"%Y%m%d-%H%M%S")
@@ -453,7 +670,7 @@ class Sweep(models.Model):
         return self.__repr__()
 
     def _get_product(self, symbol):
-        if self.data is None:
+        if self.data is None or symbol not in self.data.get("products", {}):
             self.load(suppress=True)
         return self.data["products"].get(symbol, None)
 
@@ -489,16 +706,27 @@ class Sweep(models.Model):
     def age(self):
         return datetime.datetime.now(tzinfo) - self.time
 
+    def _select_tarinfo(self, symbols):
+        # Keep only the members of the requested symbols so that the others are never extracted.
+        # A single-file archive ("*") contains all products in one member, nothing to select
+        if not self.tarinfo or "*" in self.tarinfo:
+            return self.tarinfo
+        tarinfo = {k: v for k, v in self.tarinfo.items() if k in symbols}
+        return tarinfo or self.tarinfo
+
     def load(self, symbols=["Z", "V", "W", "D", "P", "R"], finite=False, verbose=0, suppress=False):
         myname = colorize("Sweep.load()", "green")
+        tarinfo = self._select_tarinfo(symbols)
+        if verbose > 1:
+            logger.debug(f"{myname} {self} members = {list(tarinfo.keys())}")
         if datashop is None:
             try:
-                self.data = radar.read(self.path, tarinfo=self.tarinfo)
+                self.data = radar.read(self.path, symbols=symbols, tarinfo=tarinfo)
             except:
                 logger.debug(f"{myname} Unable to read {self.path}")
                 return None
         else:
-            self.data = datashop.get(self.path, tarinfo=self.tarinfo)
+            self.data = datashop.get(self.path, tarinfo=tarinfo)
         if suppress:
             return
         if "products" not in self.data:
@@ -512,6 +740,26 @@ class Sweep(models.Model):
             output["products"] = {k: v for k, v in products.items() if k in symbols}
         return output
 
+    def tally(self, data=None):
+        if data is None:
+            self.load(symbols=["Z"], suppress=True)
+            data = self.data
+        z = data.get("products", {}).get("Z") if data else None
+        if z is None:
+            return False
+        # Zero out the first few kilometers
+        if self.kind == Sweep.Kind.WDS:
+            ng = int(5000.0 / data["gatewidth"])
+        else:
+            ng = 24
+        self.total = int(z.size)
+        z = z[:, ng:]
+        self.blue = int(np.sum(z >= 5.0))
+        self.green = int(np.sum(z >= 20.0))
+        self.orange = int(np.sum(z >= 35.0))
+        self.red = int(np.sum(z >= 50.0))
+        return True
+
     def summary(self, markdown=False):
         if self.data is None:
             self.load()
@@ -602,7 +850,7 @@ class Sweep(models.Model):
             return {**origin, "last": ymd}
         sweep = query.first()
         try:
-            data = sweep.load()
+            data = sweep.load(symbols=["Z"])
         except:
             return {**origin, "last": ymd}
         if hasattr(data["latitude"], "mask") and (data["latitude"].mask or data["longitude"].mask):
@@ -0,0 +1,199 @@
+# frontend/payload.py
+#
+#   RadarHub
+#   Binary payload of a sweep for the frontend (/data/load)
+#
+#   Layout:
+#   - head (72 B): "<hhhhddddffffffff"
+#       - shape (2 x int16), length of info (int16), attr (int16)
+#       - time, latitude, longitude, 0.0 (4 x float64)
+#       - rxOffsetX, rxOffsetY, rxOffsetZ, 0.4, sweepElevation, sweepAzimuth, 0.0, gatewidth (8 x float32)
+#   - info (JSON string)
+#   - elevations (int16), azimuths (uint16)
+#   - values (uint8)
+#
+#   Level of detail (LOD): the number of gates is limited to one of `levels`
+#   (default = 1000, 0 = full resolution). Blocks of gates are reduced with
+#   a symbol-aware reducer so that small features survive the decimation
+#
+#   Compressed variants: payloads do not change once rendered, so they are
+#   compressed once (gzip, and brotli / zstd if the packages are installed)
+#   and kept alongside the raw payload in the cache and sidecar files
+#
+#   Created by Boonleng Cheong
+#
+
+import gzip
+import json
+import struct
+import numpy as np
+
+from .models import val2ind
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+levels = (250, 500, 1000, 2000, 4000)
+default_gates = 1000
+
+# Content-Encoding -> compressor, in the order of preference
+compressors = {}
+if brotli is not None:
+    compressors["br"] = lambda x: brotli.compress(x, quality=5)
+if zstandard is not None:
+    compressors["zstd"] = lambda x: zstandard.ZstdCompressor(level=10).compress(x)
+compressors["gzip"] = lambda x: gzip.compress(x, compresslevel=6, mtime=0)
+encodings = tuple(compressors.keys())
+
+
+def compress(payload, encoding):
+    """
+    Returns the payload compressed with an encoding
+
+    - payload: the raw payload, i.e., the output of pack()
+    - encoding: one of `encodings`, e.g., "gzip"
+    """
+    return compressors[encoding](payload)
+
+
+def negotiate(accept_encoding):
+    """
+    Returns the preferred encoding that the client accepts, or None for the raw payload
+
+    - accept_encoding: value of the Accept-Encoding header, e.g., "gzip, deflate, br;q=0.9"
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        token, _, params = item.strip().partition(";")
+        try:
+            q = float(params.strip()[2:]) if params.strip().startswith("q=") else 1.0
+        except ValueError:
+            q = 0.0
+        accepted[token.strip().lower()] = q
+    candidates = [x for x in encodings if accepted.get(x, accepted.get("*", 0.0)) > 0.0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda x: accepted.get(x, accepted.get("*", 0.0)))
+
+
+def lod(gates):
+    """
+    Returns the level of detail (maximum number of gates) closest to a request
+
+    - gates: requested maximum number of gates, 0 = full resolution
+
+    Any value larger than the finest level means full resolution. Invalid
+    values get the default level
+    """
+    try:
+        gates = int(gates)
+    except (TypeError, ValueError):
+        return default_gates
+    if gates <= 0:
+        return 0 if gates == 0 else default_gates
+    return next((x for x in levels if x >= gates), 0)
+
+
+def decimate(values, stride, symbol="Z"):
+    """
+    Returns a u8 array with every `stride` gates reduced into one
+
+    - values: u8 array of the product, index 0 = no data
+    - stride: number of gates in a block
+    - symbol: symbol of the product, which decides the reducer
+        - Z, W: maximum, so that small cores are preserved
+        - V: the value farthest from zero velocity (128), keeps the shear
+        - D, P, R, I: mean of the gates with data
+    """
+    if stride <= 1:
+        return values
+    # Pad with no data so that the last partial block is also reduced
+    count = -(-values.shape[1] // stride)
+    blocks = np.zeros((values.shape[0], count * stride), dtype=np.uint8)
+    blocks[:, : values.shape[1]] = values
+    blocks = blocks.reshape(values.shape[0], count, stride)
+    if symbol == "V":
+        deviation = np.abs(blocks.astype(np.int16) - 128)
+        deviation[blocks == 0] = -1
+        index = np.argmax(deviation, axis=2)[..., np.newaxis]
+        return np.take_along_axis(blocks, index, axis=2)[..., 0]
+    if symbol in ("D", "P", "R", "I"):
+        valid = np.count_nonzero(blocks, axis=2)
+        total = blocks.sum(axis=2, dtype=np.uint32)
+        mean = np.rint(total / np.maximum(valid, 1))
+        return mean.astype(np.uint8)
+    return blocks.max(axis=2)
+
+
+def encode(sweep):
+    """
+    Returns a dictionary of u8 arrays, one for each product of the `sweep`
+
+    - sweep: a sweep dictionary, i.e., the output of Sweep.load() or radar.read()
+    """
+    u8 = {}
+    for key, value in sweep["products"].items():
+        if np.ma.isMaskedArray(value):
+            value = value.filled(np.nan)
+        u8[key] = val2ind(value, symbol=key)
+    return u8
+
+
+def pack(sweep, values, symbol="Z", gates=default_gates):
+    """
+    Returns the payload (bytes) of a product
+
+    - sweep: a sweep dictionary, i.e., the output of Sweep.read()
+    - values: u8 array of the product, e.g., sweep["u8"]["Z"]
+    - symbol: symbol of the product, e.g., "Z"
+    - gates: maximum number of gates, i.e., the output of lod(), 0 = full resolution
+    """
+    # Down-sample the sweep if the gate spacing is too fine (to save internet bandwidth)
+    elevations = sweep["elevations"]
+    azimuths = sweep["azimuths"]
+    gatewidth = 1.0e-3 * sweep["gatewidth"]
+    # Only show up to gate 400 for bistatic data
+    if sweep["txrx"] == "B":
+        values = values[:, :400]
+    elif gates and values.shape[1] > gates:
+        stride = -(-values.shape[1] // gates)
+        gatewidth *= float(stride)
+        values = decimate(values, stride, symbol)
+    if sweep.get("comment", None):
+        info = json.dumps({"comment": sweep["comment"]}, separators=(",", ":"))
+    else:
+        info = json.dumps(
+            {"wf": sweep["waveform"], "prf": round(sweep["prf"])},
+            separators=(",", ":"),
+        )
+    # Final assembly of the payload
+    ei16 = np.array(elevations / 180.0 * 32768.0, dtype=np.int16)
+    au16 = np.array(azimuths / 360.0 * 65536.0, dtype=np.uint16)
+    attr = 1 if sweep["txrx"] == "B" else 0
+    head = struct.pack(
+        "<hhhhddddffffffff",
+        *values.shape,
+        len(info),
+        attr,
+        sweep["time"],
+        sweep["latitude"],
+        sweep["longitude"],
+        0.0,
+        sweep["rxOffsetX"] if attr else 0.1,
+        sweep["rxOffsetY"] if attr else 0.2,
+        sweep["rxOffsetZ"] if attr else 0.3,
+        0.4,
+        sweep["sweepElevation"],
+        sweep["sweepAzimuth"],
+        0.0,
+        gatewidth,
+    )
+    payload = bytes(head) + bytes(info, "utf-8") + bytes(ei16) + bytes(au16) + bytes(values)
+    return payload
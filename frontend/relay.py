@@ -1,4 +1,5 @@
 import json
+import time
 import redis
 import logging
 import threading
@@ -18,21 +19,44 @@ class Relay:
         self.relay = redis.StrictRedis()
         self.pubsub = self.relay.pubsub()
         self.channel = "sse-relay"
+        self.cache_channel = "cache-relay"
         global logger
         logger = kwargs.get("logger", logging.getLogger("frontend"))
 
     def _runloop(self):
         logger.info(f"{self.name} Started")
-        self.pubsub.subscribe(self.channel)
+        self.pubsub.subscribe(self.channel, self.cache_channel)
         for message in self.pubsub.listen():
             if message["type"] != "message":
                 continue
             data = json.loads(message["data"])
+            if message["channel"].decode() == self.cache_channel:
+                self._invalidate(data)
+                continue
             items = data.get("items", [])
             logger.debug(f"{self.name} {colored_variables(items)}")
             pathway = data.pop("pathway")
             send_event("sse", pathway, data)
 
+    def _invalidate(self, data):
+        from .archives import payload_cache, month_cache, month_stale, catchup_snapshots
+
+        pathway = data.get("catchup", None)
+        if pathway is not None:
+            catchup_snapshots[pathway] = (time.time(), data["payload"])
+            logger.debug(f"{self.name} {colored_variables(pathway)}")
+        month = data.get("month", None)
+        if month is not None:
+            # Marked before the pop so that the refill in _month() cannot miss it
+            month_stale.add(month)
+            month_cache.pop(month, None)
+            logger.debug(f"{self.name} {colored_variables(month)}")
+        prefix = data.get("invalidate", None)
+        if prefix is None:
+            return
+        count = payload_cache.invalidate(prefix)
+        logger.debug(f"{self.name} {colored_variables(prefix, count)}")
+
     def start(self):
         self.thread = threading.Thread(target=self._runloop)
         self.thread.daemon = True
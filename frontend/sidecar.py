@@ -0,0 +1,109 @@
+# frontend/sidecar.py
+#
+#   RadarHub
+#   Pre-rendered payloads of /data/load, stored next to the archives
+#
+#   fifo2db.process() decodes every new archive anyway, so it can write the
+#   display payload of each product at ingest time, e.g.,
+#
+#   /mnt/data/PX1000/2024/20241225/_original/PX-20241225-235939-E4.0.txz
+#   /mnt/data/PX1000/2024/20241225/_display/PX-20241225-235939-E4.0-Z.rhd
+#   /mnt/data/PX1000/2024/20241225/_display/PX-20241225-235939-E4.0-V.rhd
+#   :
+#
+#   and /data/load only needs to read the file. Only the default level of detail
+#   is pre-rendered, together with its compressed variants (.rhd.gz, .rhd.br, etc.)
+#   Enabled through settings.SIDECAR
+#
+#   Created by Boonleng Cheong
+#
+
+import os
+import radar
+import logging
+
+from django.conf import settings
+
+from .payload import compress, encode, encodings, pack
+from common import colorize, colored_variables
+
+logger = logging.getLogger("frontend")
+
+folder = "_display"
+extension = ".rhd"
+suffixes = {"gzip": ".gz", "br": ".br", "zstd": ".zst"}
+
+
+def path(source_string, root=None, encoding=None):
+    """
+    Returns the sidecar path of a source string or None if it cannot be determined
+
+    - source_string - the source of the sweep, e.g., PX-20241225-235939-E4.0-Z
+    - root - root of the data, default = settings.SIDECAR
+    - encoding - None for the raw payload or one of payload.encodings, e.g., "gzip"
+    """
+    root = root or settings.SIDECAR
+    if root is None:
+        return None
+    parts = radar.re_4parts.search(source_string)
+    if parts is None:
+        return None
+    parts = parts.groupdict()
+    entry = next((x for x in settings.RADARS.values() if x["prefix"] == parts["name"]), None)
+    if entry is None:
+        return None
+    day = parts["time"][0:8]
+    suffix = suffixes[encoding] if encoding else ""
+    return os.path.join(root, entry["folder"], day[0:4], day, folder, f"{source_string}{extension}{suffix}")
+
+
+def read(source_string, encoding=None):
+    """
+    Returns the pre-rendered payload of a source string or None if it does not exist
+
+    - source_string - the source of the sweep, e.g., PX-20241225-235939-E4.0-Z
+    - encoding - None for the raw payload or one of payload.encodings, e.g., "gzip"
+    """
+    file = path(source_string, encoding=encoding)
+    if file is None or not os.path.exists(file):
+        return None
+    with open(file, "rb") as fid:
+        return fid.read()
+
+
+def _write(file, content):
+    # Write to a temporary file first so that a reader never sees a partial payload
+    temp = f"{file}.part"
+    with open(temp, "wb") as fid:
+        fid.write(content)
+    os.replace(temp, file)
+
+
+def write(archive, sweep):
+    """
+    Writes the payloads of all products of a sweep next to its archive, returns the number of files
+
+    - archive - path of the archive, e.g., /mnt/data/PX1000/2024/20241225/_original/PX-20241225-235939-E4.0.txz
+    - sweep - the decoded sweep of the archive, i.e., the output of datashop.get() or radar.read()
+    """
+    myname = colorize("sidecar.write()", "green")
+    basename = os.path.basename(archive)
+    parts = radar.re_3parts.search(basename)
+    if parts is None or "products" not in sweep:
+        logger.warning(f"{myname} Unable to render {basename}")
+        return 0
+    parts = parts.groupdict()
+    prefix = f"{parts['name']}-{parts['time']}-{parts['scan']}"
+    count = 0
+    for symbol, values in encode(sweep).items():
+        file = path(f"{prefix}-{symbol}")
+        if file is None:
+            continue
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        payload = pack(sweep, values, symbol)
+        _write(file, payload)
+        for encoding in encodings:
+            _write(path(f"{prefix}-{symbol}", encoding=encoding), compress(payload, encoding))
+        count += 1
+    logger.debug(f"{myname}   {colored_variables(prefix, count)}")
+    return count
@@ -111,6 +111,18 @@ def size(request):
     return response
 
 
+def cache(request):
+    from .archives import payload_cache
+
+    myname = colorize("stats.cache()", "green")
+    summary = payload_cache.stats()
+    logger.debug(f"{myname}   {colored_variables(summary)}")
+    payload = json.dumps(summary)
+    response = HttpResponse(payload, content_type="application/json")
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
 @csrf_exempt
 @require_POST
 def relay(request):
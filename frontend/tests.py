@@ -1,16 +1,28 @@
+import os
+import gzip
 import json
+import datetime
 import radar
+import struct
+import time
+import tempfile
 import pprint
 import logging
+import numpy as np
 
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from django.utils.http import http_date
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
 from django.conf import settings
 
-from .models import Sweep, Day
+from .cache import PayloadCache
+from .payload import decimate, lod, negotiate
+from .relay import Relay
+from .models import Sweep, Day, HourlyCountField, TarinfoField
 from common import colorize, colored_variables
 from common import log_format
 
-from . import archives, views
+from . import archives, sidecar, views
 
 logger = logging.getLogger("frontend")
 pp = pprint.PrettyPrinter(indent=1, depth=3, width=120, sort_dicts=False)
@@ -18,6 +30,10 @@ pp = pprint.PrettyPrinter(indent=1, depth=3, width=120, sort_dicts=False)
 radar.set_logger(logger)
 
 
+async def collect(iterator):
+    return b"".join([x async for x in iterator])
+
+
 # Create your tests here.
 class FrontendTestCase(TestCase):
     databases = list(settings.DATABASES.keys())
@@ -39,6 +55,9 @@ class FrontendTestCase(TestCase):
         Day.objects.create(date="2024-12-25", name="PX", count=1, hourly_count=hourly_count)
         level = logging.DEBUG if settings.VERBOSE > 1 else logging.INFO
         logging.basicConfig(level=level, format=log_format)
+        archives.month_cache.clear()
+        archives.month_stale.clear()
+        archives.catchup_snapshots.clear()
 
     def testHello(self):
         if settings.VERBOSE > 1:
@@ -82,6 +101,59 @@ class FrontendTestCase(TestCase):
                 print(result.content)
             self.assertEqual(result.status_code, expectedStatusCode)
 
+    def testMonthQueries(self):
+        with self.assertNumQueries(1, using="data"):
+            array = archives._month("PX", "202412")
+        self.assertEqual(len(array), 31)
+        self.assertEqual(array["20241225"], Day.objects.get(date="2024-12-25", name="PX").weather_condition())
+        self.assertEqual(array["20241224"], 0)
+        # Served from month_cache until invalidated
+        with self.assertNumQueries(0, using="data"):
+            archives._month("PX", "202412")
+        # Refilled from the primary once invalidated
+        Relay()._invalidate({"month": "PX-202412"})
+        self.assertIn("PX-202412", archives.month_stale)
+        with self.assertNumQueries(1, using="data"):
+            archives._month("PX", "202412")
+        self.assertNotIn("PX-202412", archives.month_stale)
+
+    def testBuildDay(self):
+        from dbtool import build_day
+
+        Sweep.objects.create(time="2024-12-25 01:02:03Z", name="PX", scan="E4.0")
+        Sweep.objects.create(time="2024-12-25 01:12:03Z", name="PX", scan="E4.0")
+        with self.assertNumQueries(3, using="data"):
+            day, mode = build_day("PX-20241225")
+        self.assertEqual(mode, "U")
+        self.assertEqual(day.hourly_count[1], 2)
+        self.assertEqual(day.hourly_count[23], 1)
+        self.assertEqual(day.count, 3)
+
+    def testSummarize(self):
+        sweep = Sweep.objects.get(time="2024-12-25 23:59:39Z", name="PX")
+        z = np.full((360, 1000), np.nan, dtype=np.float32)
+        z[:, 100:200] = 10.0
+        z[:, 200:300] = 40.0
+        self.assertTrue(sweep.tally({"products": {"Z": z}}))
+        self.assertEqual(
+            (sweep.total, sweep.blue, sweep.green, sweep.orange, sweep.red), (360000, 72000, 36000, 36000, 0)
+        )
+        sweep.save()
+        day = Day.objects.get(date="2024-12-25", name="PX")
+        # A pure aggregate over the gate counts, no archive is read
+        with self.assertNumQueries(2, using="data"):
+            day.summarize()
+        self.assertEqual((day.blue, day.green, day.orange, day.red), (2000, 500, 1000, 0))
+
+    def testCatchup(self):
+        payload = archives.catchup_snapshot("px1000")
+        self.assertEqual(json.loads(payload)["dateTimeString"], "20241225-2300")
+        # A snapshot from backhaul.monitor is served without any query
+        archives.catchup_snapshots["px1000"] = (time.time(), payload)
+        with self.assertNumQueries(0, using="data"):
+            result = archives.catchup("django-test", "px1000")
+        self.assertEqual(result.content.decode("utf-8"), payload)
+
     def testCount(self):
         for pathway, day, expectedStatusCode in [
             ("px1000", "20241225", 200),
@@ -123,6 +195,69 @@ class FrontendTestCase(TestCase):
                     logger.debug(colorize(message, "mint"))
             self.assertEqual(result.status_code, expectedStatusCode)
 
+    def testConditional(self):
+        factory = RequestFactory(headers={"Accept-Encoding": "gzip"})
+        for view, args in [
+            (archives.count, ("px1000", "20241225")),
+            (archives.table, ("px1000", "20241225-2300")),
+            (archives.load, ("px1000", "20241225-235939-E4.0-Z")),
+        ]:
+            result = view(factory.get("/"), *args)
+            self.assertEqual(result.status_code, 200)
+            etag = result.headers["ETag"]
+            result = view(factory.get("/", headers={"If-None-Match": etag}), *args)
+            self.assertEqual(result.status_code, 304)
+        # A cached payload is served and validated without any query
+        with self.assertNumQueries(0, using="data"):
+            result = archives.load(factory.get("/"), "px1000", "20241225-235939-E4.0-Z")
+            self.assertEqual(result.status_code, 200)
+        # A new sweep changes the hourly count, so the old ETag is no longer valid
+        request = factory.get("/")
+        etag = archives.count(request, "px1000", "20241225").headers["ETag"]
+        Day.objects.filter(date="2024-12-25", name="PX").update(hourly_count=",".join(["0"] * 23) + ",2")
+        result = archives.count(factory.get("/", headers={"If-None-Match": etag}), "px1000", "20241225")
+        self.assertEqual(result.status_code, 200)
+
+    def testLoadMany(self):
+        factory = RequestFactory(headers={"Accept-Encoding": "gzip"})
+        for query in [
+            {"locators": "20241225-235939-E4.0-Z,20241225-235939-E4.0-V,20210101-012345-E4.0-Z"},
+            {"start": "20241225-2300", "end": "20241225-235959", "scan": "E4.0", "symbol": "Z"},
+        ]:
+            result = async_to_sync(archives.load_many)(factory.get("/", query), "px1000")
+            self.assertEqual(result.status_code, 200)
+            self.assertTrue(result.is_async)
+            content = async_to_sync(collect)(result.streaming_content)
+            records = {}
+            while content:
+                (n,) = struct.unpack("<H", content[:2])
+                name = content[2 : 2 + n].decode("utf-8")
+                (m,) = struct.unpack("<I", content[2 + n : 6 + n])
+                records[name] = content[6 + n : 6 + n + m]
+                content = content[6 + n + m :]
+            for name, payload in records.items():
+                self.assertEqual(payload, archives.load_display_data_by_source_string(name) or b"")
+        result = async_to_sync(archives.load_many)(factory.get("/"), "px1000")
+        self.assertEqual(result.status_code, 204)
+
+    def testSelectiveLoad(self):
+        sweep = Sweep.objects.filter(time="2024-12-25 23:59:39Z", name="PX").first()
+        data = sweep.load(symbols=["Z"])
+        self.assertEqual(list(data["products"].keys()), ["Z"])
+        self.assertEqual(list(sweep._select_tarinfo(["Z"]).keys()), ["Z"])
+
+    def testSidecar(self):
+        source = "PX-20241225-235939-E4.0-Z"
+        sweep = Sweep.objects.filter(time="2024-12-25 23:59:39Z", name="PX").first()
+        data = sweep.load()
+        with tempfile.TemporaryDirectory() as root, override_settings(SIDECAR=root):
+            count = sidecar.write(sweep.path, data)
+            self.assertEqual(count, len(data["products"]))
+            # Pre-rendered payload must be identical to the one rendered on request
+            self.assertEqual(sidecar.read(source), archives._load_display_data(source))
+            self.assertEqual(gzip.decompress(sidecar.read(source, encoding="gzip")), sidecar.read(source))
+        self.assertIsNone(sidecar.read(source))
+
     def testLatest(self):
         for name in ["PX", "RAXPOL", "XYZ"]:
             ymd, hour = archives.latest(name)
@@ -132,3 +267,285 @@ class FrontendTestCase(TestCase):
             else:
                 self.assertIsNone(ymd)
                 self.assertIsNone(hour)
+
+
+class PayloadCacheTestCase(SimpleTestCase):
+    def testHitMiss(self):
+        cache = PayloadCache(budget=1024)
+        self.assertIsNone(cache.get("PX-20241225-235939-E4.0-Z"))
+        cache.put("PX-20241225-235939-E4.0-Z", b"\x01" * 100)
+        self.assertEqual(cache.get("PX-20241225-235939-E4.0-Z"), b"\x01" * 100)
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 100)
+        # Lookups that are part of another are not counted
+        cache.get("PX-20241225-235939-E4.0-V", count=False)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def testEviction(self):
+        cache = PayloadCache(budget=300)
+        for k in range(3):
+            cache.put(f"PX-20241225-23593{k}-E4.0-Z", bytes(100))
+        # Touch the oldest so that the second one becomes the least recently used
+        cache.get("PX-20241225-235930-E4.0-Z")
+        cache.put("PX-20241225-235933-E4.0-Z", bytes(100))
+        self.assertIn("PX-20241225-235930-E4.0-Z", cache)
+        self.assertNotIn("PX-20241225-235931-E4.0-Z", cache)
+        self.assertEqual(cache.size, 300)
+        self.assertEqual(cache.stats()["evictions"], 1)
+        # Payloads larger than the budget are not kept
+        self.assertFalse(cache.put("PX-20241225-235934-E4.0-Z", bytes(301)))
+
+    def testInvalidate(self):
+        cache = PayloadCache(budget=1024)
+        for symbol in ["Z", "V", "W"]:
+            cache.put(f"PX-20241225-235939-E4.0-{symbol}", bytes(10))
+        cache.put("PX-20241225-235959-E4.0-Z", bytes(10))
+        self.assertEqual(cache.invalidate("PX-20241225-235939-E4.0-"), 3)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 10)
+
+
+class PayloadTestCase(SimpleTestCase):
+    def testLevelOfDetail(self):
+        for gates, expected in [(None, 1000), ("abc", 1000), (0, 0), (100, 250), ("500", 500), (1500, 2000), (9999, 0)]:
+            self.assertEqual(lod(gates), expected)
+
+    def testNegotiate(self):
+        self.assertEqual(negotiate("gzip, deflate"), "gzip")
+        self.assertEqual(negotiate("gzip;q=0, identity"), None)
+        self.assertEqual(negotiate(""), None)
+
+    def testDecimate(self):
+        values = np.array([[0, 10, 200, 0, 0, 5, 0]], dtype=np.uint8)
+        self.assertEqual(decimate(values, 3, "Z").tolist(), [[200, 5, 0]])
+        self.assertEqual(decimate(values, 3, "V").tolist(), [[10, 5, 0]])
+        self.assertEqual(decimate(values, 3, "D").tolist(), [[105, 5, 0]])
+        self.assertIs(decimate(values, 1, "Z"), values)
+
+
+class HourlyCountFieldTestCase(SimpleTestCase):
+    def testPacking(self):
+        field = HourlyCountField()
+        counts = tuple(range(24))
+        packed = field.get_prep_value(counts)
+        self.assertEqual(len(packed), 96)
+        self.assertEqual(field.to_python(packed), counts)
+        # Legacy comma-separated form, as a string or cast to bytes by the migration
+        legacy = ",".join(str(n) for n in counts)
+        self.assertEqual(field.to_python(legacy), counts)
+        self.assertEqual(field.to_python(legacy.encode("ascii")), counts)
+        self.assertRaises(ValueError, field.to_python, "1,2,3")
+
+    def testActiveHours(self):
+        day = Day(date="2024-12-25", name="PX", hourly_count=",".join(["0"] * 22) + ",4,1")
+        self.assertEqual(day.hourly_count[22], 4)
+        self.assertEqual((day.first_hour, day.last_hour), (22, 23))
+        day.hourly_count = [0] * 24
+        self.assertIsNone(day.first_hour)
+
+
+class TarinfoFieldTestCase(SimpleTestCase):
+    def testPacking(self):
+        field = TarinfoField()
+        tarinfo = {
+            s: [f"PX-20241225-235939-E4.0-{s}.nc", 9000 + k, 1024 * k, 1024 * k + 512] for k, s in enumerate("ZVW")
+        }
+        sweep = Sweep(
+            time=datetime.datetime(2024, 12, 25, 23, 59, 39, tzinfo=datetime.timezone.utc), name="PX", scan="E4.0"
+        )
+        sweep.tarinfo = tarinfo
+        # Member names derived from the sweep are left out
+        packed = field.get_prep_value(sweep.tarinfo)
+        self.assertEqual(len(packed), 1 + 3 * 15)
+        self.assertEqual(field.to_python(packed)["V"], ["", 9001, 1024, 1536])
+        sweep.tarinfo = field.to_python(packed)
+        self.assertEqual(sweep.tarinfo, tarinfo)
+        # Legacy JSON rows
+        self.assertEqual(field.to_python(json.dumps(tarinfo).encode("utf-8")), tarinfo)
+        self.assertEqual(field.to_python(field.get_prep_value({"*": ["a.nc", 1, 2, 3]})), {"*": ["a.nc", 1, 2, 3]})
+
+
+class IngestTestCase(TestCase):
+    databases = list(settings.DATABASES.keys())
+
+    def testDatashopConnections(self):
+        import fifo2db
+        from radar.product.share import Manager
+
+        for workers in [1, 4, 8]:
+            self.assertEqual(Manager(**fifo2db.datashop_options(workers)).count, workers)
+
+    def testProcessBatchConnections(self):
+        import fifo2db
+        import threading
+
+        class Datashop:
+            count = 4
+
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.active = 0
+                self.peak = 0
+
+            def get(self, file, want_tarinfo=False):
+                with self.lock:
+                    self.active += 1
+                    self.peak = max(self.peak, self.active)
+                time.sleep(0.05)
+                with self.lock:
+                    self.active -= 1
+                z = np.full((360, 100), 30.0, dtype=np.float32)
+                return {"kind": Sweep.Kind.UNK, "gatewidth": 150.0, "products": {"Z": z}}, {}
+
+        class Scheduler:
+            def mark(self, name, time, bgor=False):
+                pass
+
+        prefix = next(iter(fifo2db.radars.values()))["prefix"]
+        datashop, scheduler = fifo2db.datashop, fifo2db.scheduler
+        fifo2db.datashop, fifo2db.scheduler = Datashop(), Scheduler()
+        get = fifo2db.datashop.get
+        try:
+            with tempfile.TemporaryDirectory() as folder, override_settings(SIDECAR=None):
+                sources = []
+                for k in range(8):
+                    sources.append(f"{folder}/{prefix}-20241225-0100{k:02d}-E4.0.tar.xz")
+                    open(sources[-1], "wb").close()
+                self.assertEqual(fifo2db.process_batch(sources), 8)
+                self.assertEqual(fifo2db.datashop.peak, fifo2db.datashop.count)
+                self.assertEqual(fifo2db.process_batch(sources), 0)
+                # A file that fails does not take the rest of the batch with it
+                sources = [f"{folder}/{prefix}-20241225-0200{k:02d}-E4.0.tar.xz" for k in range(4)]
+                for source in sources:
+                    open(source, "wb").close()
+
+                def broken(file, want_tarinfo=False):
+                    if "020001" in file:
+                        raise ValueError("corrupted archive")
+                    return get(file, want_tarinfo=want_tarinfo)
+
+                fifo2db.datashop.get = broken
+                self.assertEqual(fifo2db.process_batch(sources), 3)
+        finally:
+            fifo2db.datashop, fifo2db.scheduler = datashop, scheduler
+
+    def testDayScheduler(self):
+        import fifo2db
+        from dbtool import build_day as dbtool_build_day
+
+        for minute in [1, 2, 3]:
+            Sweep.objects.create(time=f"2024-12-25 01:0{minute}:00Z", name="DX", scan="E4.0")
+        calls = []
+
+        def build_day(source, bgor=False):
+            calls.append(source)
+            if len(calls) == 1:
+                raise RuntimeError("connection lost")
+            return dbtool_build_day(source, bgor=bgor)
+
+        # Updates on this thread only, every marked day is due
+        scheduler = fifo2db.DayScheduler(delay=3600.0, max_delay=0.0)
+        scheduler.stop()
+        fifo2db.build_day = build_day
+        try:
+            for minute in [1, 2, 3]:
+                scheduler.mark("DX", datetime.datetime(2024, 12, 25, 1, minute, tzinfo=datetime.timezone.utc))
+            scheduler._update()
+            self.assertEqual(scheduler.depth, 1)
+            scheduler._update()
+            self.assertEqual(scheduler.depth, 0)
+        finally:
+            fifo2db.build_day = dbtool_build_day
+        self.assertEqual(calls, ["DX-20241225", "DX-20241225"])
+        day = Day.objects.get(date="2024-12-25", name="DX")
+        self.assertEqual(day.count, 3)
+        self.assertEqual(day.hourly_count[1], 3)
+
+    def testBatcherWindow(self):
+        import fifo2db
+
+        batches = []
+        process_batch = fifo2db.process_batch
+        fifo2db.process_batch = lambda sources, wait=0.0: batches.append(sources)
+        try:
+            batcher = fifo2db.Batcher(size=100, window=0.05)
+            # A steady stream, faster than any idle poll(), still goes out once per window
+            for k in range(12):
+                batcher.add(f"file-{k}")
+                time.sleep(0.01)
+            batcher.flush()
+        finally:
+            fifo2db.process_batch = process_batch
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(sum(batches, []), [f"file-{k}" for k in range(12)])
+
+    def testSidecarFailure(self):
+        import fifo2db
+
+        class Datashop:
+            def get(self, file, want_tarinfo=False):
+                z = np.full((360, 100), 30.0, dtype=np.float32)
+                return {"kind": Sweep.Kind.UNK, "gatewidth": 150.0, "products": {"Z": z}}, {}
+
+        def write(file, data):
+            raise KeyError("waveform")
+
+        datashop, write_sidecar = fifo2db.datashop, fifo2db.sidecar.write
+        fifo2db.datashop, fifo2db.sidecar.write = Datashop(), write
+        try:
+            with override_settings(SIDECAR="/mnt/data"):
+                time = datetime.datetime(2024, 12, 25, 1, tzinfo=datetime.timezone.utc)
+                task = {"file": "DX-20241225-010000-E4.0.tar.xz", "name": "DX", "time": time, "scan": "E4.0"}
+                sweep = fifo2db.extract(task)
+        finally:
+            fifo2db.datashop, fifo2db.sidecar.write = datashop, write_sidecar
+        self.assertIsNotNone(sweep)
+        self.assertEqual(sweep.total, 36000)
+
+    def testLoadValidators(self):
+        pathway, item = next(iter(settings.RADARS.items()))
+        source = f"{item['prefix']}-20241225-010000-E4.0-Z"
+        prefix = source[:-1]
+        factory = RequestFactory(headers={"Accept-Encoding": "gzip"})
+        archives.payload_cache.invalidate(prefix)
+        with tempfile.NamedTemporaryFile(suffix=".tar.xz") as file:
+            sweep = Sweep.objects.create(time="2024-12-25 01:00:00Z", name=item["prefix"], scan="E4.0", path=file.name)
+            etag, last_modified = archives._load_validators(source, 1000, "gzip")
+            self.assertEqual(last_modified, int(os.path.getmtime(file.name)))
+            # Kept with the payloads, so the next request does not query
+            with self.assertNumQueries(0, using="data"):
+                self.assertEqual(archives._load_validators(source, 1000, "gzip"), (etag, last_modified))
+                request = factory.get("/", headers={"If-Modified-Since": http_date(last_modified)})
+                self.assertEqual(archives.load(request, pathway, "20241225-010000-E4.0-Z").status_code, 304)
+            # A re-ingested sweep is invalidated along with its payloads and gets a new ETag
+            sweep.delete()
+            Sweep.objects.create(time="2024-12-25 01:00:00Z", name=item["prefix"], scan="E4.0", path=file.name)
+            archives.payload_cache.invalidate(prefix)
+            self.assertNotEqual(archives._load_validators(source, 1000, "gzip")[0], etag)
+        archives.payload_cache.invalidate(prefix)
+
+    def testRecheck(self):
+        import asyncio
+        import fifo2db
+
+        calls = []
+        catchup, ingest, catchup_root = fifo2db.catchup, fifo2db.ingest, fifo2db.catchup_root
+        fifo2db.catchup = lambda root, lookback=1, batch=100: calls.append(("catchup", root, lookback))
+        fifo2db.ingest = lambda file: calls.append(("ingest", file))
+        fifo2db.catchup_root = "/mnt/data"
+
+        async def run():
+            queue = asyncio.Queue()
+            # A source that connects queues recheck() ahead of its announcements
+            for item in [fifo2db.recheck, "a.tar.xz", "b.tar.xz"]:
+                queue.put_nowait(item)
+            fifo2db.keepReading = False
+            await fifo2db.consume(queue)
+
+        try:
+            asyncio.run(run())
+        finally:
+            fifo2db.catchup, fifo2db.ingest, fifo2db.catchup_root = catchup, ingest, catchup_root
+        self.assertEqual(calls, [("catchup", "/mnt/data", 0), ("ingest", "a.tar.xz"), ("ingest", "b.tar.xz")])
@@ -1,7 +1,24 @@
+from django.conf import settings
+
+# Reads go to the replica, if there is one, unless the process is pinned to the primary
+primary_only = False
+
+
+def use_primary():
+    """
+    Pins the reads of this process to the primary, for the processes that read what they just
+    wrote, e.g., fifo2db.py, dbtool.py and backhaul, which cannot wait for the replica to catch up
+    """
+    global primary_only
+    primary_only = True
+
+
 class DbRouter(object):
     def db_for_read(self, model, **hints):
         # print(f"db_for_read() {model._meta.app_label}")
         if model._meta.app_label == "frontend" and model._meta.model_name in ["file", "day", "sweep"]:
+            if not primary_only and "replica" in settings.DATABASES:
+                return "replica"
             return "data"
         return "default"
 
@@ -140,15 +140,34 @@ DATABASES = {
     }
 }
 
+# Connections to 'data' are kept open for CONN_MAX_AGE seconds and checked before reuse, or taken
+# from a pool if "pool" is set and psycopg 3 is installed. With "replica", the archive views read
+# from the replica at that host while fifo2db.py, dbtool.py and backhaul stay on the primary
+#
+# "database": { "host": ..., "user": ..., "pass": ..., "conn_max_age": 600, "pool": false, "replica": None }
+
 if "database" in user_settings:
+    database = user_settings["database"]
     DATABASES["data"] = {
         "ENGINE": "django.db.backends.postgresql",
         "NAME": "radarhub",
-        "HOST": user_settings["database"]["host"],
-        "USER": user_settings["database"]["user"],
-        "PASSWORD": user_settings["database"]["pass"],
+        "HOST": database["host"],
+        "USER": database["user"],
+        "PASSWORD": database["pass"],
         "PORT": "5432",
+        "CONN_MAX_AGE": database.get("conn_max_age", 600),
+        "CONN_HEALTH_CHECKS": True,
     }
+    if database.get("pool", False):
+        try:
+            import psycopg_pool
+
+            pool = database["pool"] if isinstance(database["pool"], dict) else {"min_size": 2, "max_size": 16}
+            DATABASES["data"].update({"CONN_MAX_AGE": 0, "OPTIONS": {"pool": pool}})
+        except ImportError:
+            print("psycopg_pool is not installed, using persistent connections instead")
+    if database.get("replica", None):
+        DATABASES["replica"] = {**DATABASES["data"], "HOST": database["replica"], "TEST": {"MIRROR": "data"}}
 else:
     DATABASES["data"] = DATABASES["default"]
 
@@ -227,8 +246,11 @@ if "radars" in user_settings:
 # FIFO source to list for new files for fifo2db.py
 #
 # FIFO = { 'tcp': '_IP_ADDRESS_:_PORT_' } or { 'pipe': '/tmp/radarhub.fifo' }
+#
+# Either can be a list, e.g., { 'tcp': ['10.197.14.52:9000', '10.197.14.60:9000'] }, which are
+# served concurrently by one fifo2db.py
 
-FIFO = user_settings.get("fifo", {"pipe", "/tmp/radarhub.fifo"})
+FIFO = user_settings.get("fifo", {"pipe": "/tmp/radarhub.fifo"})
 
 # DATASHOP source
 #
@@ -236,6 +258,29 @@ FIFO = user_settings.get("fifo", {"pipe", "/tmp/radarhub.fifo"})
 
 DATASHOP = user_settings.get("datashop", "localhost")
 
+# Payload cache of /data/load
+#
+# PAYLOAD_CACHE = { 'backend': 'memory' or 'redis', 'budget': _MAXIMUM_SIZE_IN_BYTES_ }
+#
+# 'memory' is private to each daphne process, 'redis' is shared by all of them
+
+PAYLOAD_CACHE = {"backend": "memory", "budget": 256 * 1024 * 1024}
+if "cache" in user_settings:
+    PAYLOAD_CACHE.update(user_settings["cache"])
+
+# Pre-rendered payloads of /data/load, written by fifo2db.py next to the archives
+#
+# SIDECAR = None (disabled) or the root of the data, e.g., "/mnt/data"
+
+SIDECAR = user_settings.get("sidecar", None)
+
+# Archive views (/data/...)
+#
+# ARCHIVE_ASYNC = True (async views on a pool of ARCHIVE_WORKERS threads) or False (sync views)
+
+ARCHIVE_ASYNC = user_settings.get("async", True)
+ARCHIVE_WORKERS = user_settings.get("archive_workers", 8)
+
 # Prevent HttpResponse 301 for permanent forwards
 # APPEND_SLASH = False
 